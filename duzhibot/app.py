@@ -1,44 +1,61 @@
+import base64
+import hashlib
+import hmac
+import json
 import logging
 import multiprocessing as mp
 import os
 import shutil
+import socket
 import sys
-from contextlib import AbstractContextManager
-from typing import Optional, cast
+import time
+from functools import partial
+from typing import Any, Dict, List, Optional, Set, cast
 
 from dotenv import load_dotenv
 from flask import Blueprint, Flask, abort
 from flask import g as fg
-from flask import jsonify, request, send_file
+from flask import jsonify, request
 from flask.logging import default_handler
 from flask.typing import ResponseReturnValue
 from flask.wrappers import Response
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
-from linebot.models import MessageEvent, TextMessage
+from linebot.webhook import SignatureValidator
+from linebot.models import Event, MessageEvent, SendMessage, TextMessage
 from linebot.models.sources import SourceUser
-from werkzeug.utils import redirect, send_from_directory
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.utils import redirect
 
+import assets
+import diagram
 import file
+import logs
+import metrics
 import parse
-from db import User, db
-from fsm import WorldModel, world_machine
-from fsm_utils import machine_ctx_mnger
+from db import (InsufficientWealthError, User, db, engine_options,
+                init_state_cache)
+from evqueue import EventQueue, QueuedEvent
+from fsm import WorldModel, quick_reply_texts
+from reply import ReplySender, SessionHttpClient
 
 load_dotenv()
 
 
 _LOGGER_ROOT = logging.getLogger()
-_LOGGER_ROOT.addHandler(default_handler)
+logs.install(_LOGGER_ROOT, default_handler)
 
 
 class App(Flask):
     def __init__(self, *args, **kwargs) -> None:
         kwargs.setdefault("static_url_path", "")
+        # Serve the static files with `assets` instead
+        kwargs["static_folder"] = None
         super().__init__(*args, **kwargs)
         _LOGGER_ROOT.setLevel(self.logger.getEffectiveLevel())
-        self.config["SEND_FILE_MAX_AGE_DEFAULT"] = 0
         init_db(self)
+        init_parse_cache()
+        tmp_store.start()
 
     def run(self, *args, **kwargs) -> None:
         if not self.debug or os.getenv('WERKZEUG_RUN_MAIN') == 'true':
@@ -59,6 +76,21 @@ tmp_url = "tmp"
 """ The relative URL for temporary contents. """
 tmp_dir = _url_to_path(tmp_url)
 """ The path on the file system for temporary file contents. """
+tmp_store = file.TmpStore(
+    tmp_dir,
+    budget=int(os.getenv("TMP_STORE_BUDGET", 256 * 1024 * 1024)),
+    ttl=float(os.getenv("TMP_STORE_TTL", 24 * 60 * 60)),
+    buffer_size=int(os.getenv("TMP_STORE_BUFFER_SIZE", file.default_buffer_size)),
+)
+""" The temporary contents, removed once expired or over budget. """
+metrics.stats_metrics(
+    "duzhibot_tmp_store", "The usage of the temporary contents",
+    lambda: {(k,): v for k, v in tmp_store.stats().items()}, {
+        "saves": "Temporary contents saved",
+        "dedups": "Temporary contents saved already",
+        "evictions": "Temporary contents removed for the budget",
+        "expirations": "Temporary contents removed for their age",
+    })
 
 
 # get required variables from your environment
@@ -82,11 +114,109 @@ def init_db(app: Flask) -> None:
     if database_url.startswith("postgres://"):
         database_url = database_url.replace("postgres://", "postgresql://", 1)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+    flush_interval = os.getenv("STATE_CACHE_FLUSH_INTERVAL")
+    web_threads = os.getenv("WEB_THREADS")
+    # a connection for each handler thread and the cache writer if enabled
+    pool_size = int(os.getenv("DB_POOL_SIZE",
+                              int(web_threads or 1) + (flush_interval is not None)))
+    # more at peak for the threads of the development server, which are unbounded
+    max_overflow = 0 if web_threads is not None else 10
+    max_connections = os.getenv("DB_MAX_CONNECTIONS")
+    if max_connections is not None:
+        # shared by the gunicorn workers and `python worker.py` if the queue is enabled
+        processes = int(os.getenv("WEB_CONCURRENCY", 1)) + bool(os.getenv("WEBHOOK_QUEUE"))
+        per_process = max(1, int(max_connections) // processes)
+        pool_size = min(pool_size, per_process)
+        max_overflow = per_process - pool_size
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        database_url, pool_size, max_overflow,
+        pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        pool_recycle=float(os.getenv("DB_POOL_RECYCLE", 1800)),
+        statement_timeout=int(os.getenv("DB_STATEMENT_TIMEOUT", 10000)),
+        external_pooler=os.getenv("DB_EXTERNAL_POOLER", "0") == "1")
     db.init_app(app)
 
+    # write the user states behind if enabled
+    if flush_interval is not None:
+        init_state_cache(
+            app, float(flush_interval),
+            int(os.getenv("STATE_CACHE_BATCH_SIZE", 100)))
 
-line_bot_api = LineBotApi(channel_access_token)
+
+def init_parse_cache() -> None:
+    # size the cache for the parse results and fill it with known texts
+    maxsize = os.getenv("PARSE_CACHE_SIZE")
+    if maxsize is not None:
+        parse.parse_cache.resize(int(maxsize))
+    parse.parse_cache.warm(quick_reply_texts)
+
+
+reply_workers = int(os.getenv("REPLY_WORKERS", 0))
+""" The number of threads sending the replies; send in the handler if 0. """
+
+
+class _LineBotApi(LineBotApi):
+    def reply_message(self, *args, **kwargs) -> None:
+        with metrics.stage("reply"):
+            return super().reply_message(*args, **kwargs)
+
+
+class _SignatureValidator(SignatureValidator):
+    def validate(self, body: str, signature: str) -> bool:
+        with metrics.stage("verify"):
+            return super().validate(body, signature)
+
+
+line_bot_api = _LineBotApi(
+    channel_access_token,
+    endpoint=os.getenv("LINE_API_ENDPOINT", LineBotApi.DEFAULT_API_ENDPOINT),
+    # a connection for each sender thread, or for each handler thread sending inline
+    http_client=partial(SessionHttpClient, pool_size=max(
+        reply_workers, int(os.getenv("WEB_THREADS", 1)), 1)))
 handler = WebhookHandler(channel_secret)
+handler.parser.signature_validator = _SignatureValidator(channel_secret)
+
+reply_sender: Optional[ReplySender] = None
+if reply_workers > 0:
+    reply_sender = ReplySender(
+        line_bot_api, reply_workers,
+        max_queue=int(os.getenv("REPLY_QUEUE_SIZE", 1000)),
+        deadline=float(os.getenv("REPLY_DEADLINE", 30)))
+    reply_sender.start()
+    metrics.stats_metrics(
+        "duzhibot_reply_sender", "The queue depth and the counters of the reply sender",
+        lambda: {(k,): v for k, v in reply_sender.stats().items()}, {
+            "sent": "Replies sent",
+            "failed": "Replies failed with permanent errors",
+            "expired": "Replies given up after their deadlines",
+            "retried": "Retries of replies after transient errors",
+            "overflowed": "Replies sent in the handler as the queue is full",
+        })
+
+
+def send_reply(reply_token: str, msgs: List[SendMessage]) -> None:
+    """ Reply `msgs` with `reply_token` through `reply_sender` if enabled. """
+    if reply_sender is not None:
+        reply_sender.submit(reply_token, msgs)
+    else:
+        line_bot_api.reply_message(reply_token, msgs)
+
+
+webhook_batch = os.getenv("WEBHOOK_BATCH", "0") != "0"
+""" Whether to handle the events in a webhook body as a batch. """
+
+webhook_queue: Optional[EventQueue] = None
+""" The queue of the events to handle by workers if ack-first mode is enabled. """
+if os.getenv("WEBHOOK_QUEUE"):
+    webhook_queue = EventQueue(os.environ["WEBHOOK_QUEUE"])
+    metrics.Gauge(
+        "duzhibot_webhook_queue_depth", "Events waiting in the webhook queue",
+        lambda: {(): len(webhook_queue)})
+_queued_events = metrics.Counter(
+    "duzhibot_webhook_queue_events_total",
+    "Queued events taken by this worker by outcome", ["outcome"])
 
 
 @bp.route("/callback", methods=["POST"])
@@ -94,11 +224,34 @@ def callback() -> ResponseReturnValue:
     signature = request.headers["X-Line-Signature"]
     # get request body as text
     body = request.get_data(as_text=True)
-    _LOGGER_ROOT.info(f"Request body: {body}")
+    logs.log(_LOGGER_ROOT, "body", logging.INFO, "Request body:",
+             len=len(body), body=logs.Body(body))
+
+    if webhook_queue is not None:
+        # only validate and enqueue the events for the workers
+        if not handler.parser.signature_validator.validate(body, signature):
+            abort(400)
+        try:
+            payload = json.loads(body)
+            events = payload["events"]
+        except (ValueError, KeyError, TypeError):
+            abort(400)
+        webhook_queue.put(events, payload.get("destination"))
+        return cast(ResponseReturnValue, "OK")
+
+    handle_body(body, signature)
+    return cast(ResponseReturnValue, "OK")
 
-    # handle webhook body
+
+def handle_body(body: str, signature: str) -> None:
+    """ Handle the webhook `body` signed with `signature`.
+        The errors from the handlers are logged.
+    """
     try:
-        handler.handle(body, signature)
+        if webhook_batch:
+            handle_events(handler.parser.parse(body, signature))
+        else:
+            handler.handle(body, signature)
     except LineBotApiError as e:
         _LOGGER_ROOT.exception(
             "Got exception from LINE Messaging API", exc_info=e)
@@ -107,78 +260,258 @@ def callback() -> ResponseReturnValue:
     except Exception as e:
         _LOGGER_ROOT.exception("Got exception from handler", exc_info=e)
 
-    return cast(ResponseReturnValue, "OK")
-
-
-@handler.add(MessageEvent, message=TextMessage)
-def handle_text_message(event: MessageEvent) -> None:
-    if not isinstance(event.source, SourceUser):
-        return
 
+def dispatch_events(events: List[Event]) -> List[Event]:
+    """ Handle the parsed `events`, whose signatures are already validated,
+        as a batch if `webhook_batch` is `True` or one by one otherwise.
+        Return the events which are not handled due to errors,
+        including the rest of the events of the same users, which are skipped.
+    """
+    if webhook_batch:
+        return handle_events(events)
+    failed: List[Event] = []
+    failed_users: Set[str] = set()
+    for event in events:
+        # the only events handled by `handler`
+        if not _is_user_text_message(event):
+            continue
+        if event.source.user_id in failed_users:
+            failed.append(event)
+            continue
+        try:
+            handle_text_message(event)
+        except LineBotApiError as e:
+            # raised after the state is saved
+            _LOGGER_ROOT.exception(
+                "Got exception from LINE Messaging API", exc_info=e)
+        except Exception as e:
+            _LOGGER_ROOT.exception(
+                f"Failed to handle event of user {event.source.user_id}", exc_info=e)
+            failed.append(event)
+            failed_users.add(event.source.user_id)
+    return failed
+
+
+def _is_user_text_message(event: Event) -> bool:
+    return (isinstance(event, MessageEvent)
+            and isinstance(event.message, TextMessage)
+            and isinstance(event.source, SourceUser))
+
+
+def _exec_event(user: User, event: MessageEvent, commit: bool = True) -> List[SendMessage]:
+    """ Run the machine of `user` for `event`, save the result,
+        and return the messages to reply.
+        If `commit` is `False`, the caller should commit the session.
+    """
     msgs = []
 
     def reply(msg: WorldModel.Msg_t) -> None:
         msgs.extend(msg if isinstance(msg, list) else (msg,))
 
-    user = User.from_user_id(event.source.user_id)
-    _LOGGER_ROOT.info(f"Loaded data for user {user.user_id}: {user.state}")
+    logs.log(_LOGGER_ROOT, "state", logging.INFO, "Loaded data for user",
+             user_id=user.user_id, state=user.state)
 
-    model = user.load_machine_model()
-    with machine_ctx_mnger(world_machine, model):
+    with user.load_machine_model() as model:
         model.exec(event, reply)
-        user.save_machine_model(model)
-        _LOGGER_ROOT.info(f"Saved data for user {user.user_id}: {user.state}")
+        with metrics.stage("save"):
+            user.save_machine_model(model, commit=commit)
+        logs.log(_LOGGER_ROOT, "state", logging.INFO, "Saved data for user",
+                 user_id=user.user_id, state=user.state)
+
+    return msgs[-5:]
+
+
+@handler.add(MessageEvent, message=TextMessage)
+def handle_text_message(event: MessageEvent) -> None:
+    if not isinstance(event.source, SourceUser):
+        return
+
+    with metrics.stage("load"):
+        user = User.from_user_id(event.source.user_id)
+    try:
+        msgs = _exec_event(user, event)
+    except InsufficientWealthError as e:
+        # Nothing is written for the event; not retried as it would fail again
+        _LOGGER_ROOT.warning(f"Skipped event of user {user.user_id}: {e}")
+        return
 
     if len(msgs):
-        line_bot_api.reply_message(event.reply_token, msgs[-5:])
+        send_reply(event.reply_token, msgs)
+
+
+def handle_events(events: List[Event]) -> List[Event]:
+    """ Handle the text message events in `events` as a batch:
+        load all involved users with one query,
+        handle the events of each user in order,
+        save all changes in one transaction,
+        in which the failed events of a user affect no other users,
+        and then send the replies.
+        Return the events of the users whose events are rolled back due to errors.
+    """
+    # group the events by users, preserving the order for each user
+    user_events: Dict[str, List[MessageEvent]] = {}
+    for event in events:
+        if _is_user_text_message(event):
+            user_events.setdefault(event.source.user_id, []).append(event)
+    if not user_events:
+        return []
+
+    with metrics.stage("load"):
+        users = User.from_user_ids(user_events.keys())
+    replies = []
+    failed: List[Event] = []
+    for user_id, evs in user_events.items():
+        user_replies = []
+        try:
+            # isolate the writes of each user from the failures of the others
+            with db.session.begin_nested():
+                for event in evs:
+                    try:
+                        msgs = _exec_event(users[user_id], event, commit=False)
+                    except StaleDataError as e:
+                        # Nothing is written for the event; skip the rest of the user
+                        _LOGGER_ROOT.exception(
+                            f"Skipped events of user {user_id}", exc_info=e)
+                        break
+                    except InsufficientWealthError as e:
+                        _LOGGER_ROOT.warning(f"Skipped events of user {user_id}: {e}")
+                        break
+                    if len(msgs):
+                        user_replies.append((event.reply_token, msgs))
+        except Exception as e:
+            # The writes might be partial; roll back all events of the user
+            _LOGGER_ROOT.exception(
+                f"Rolled back events of user {user_id}", exc_info=e)
+            failed.extend(evs)
+            continue
+        replies.extend(user_replies)
+    with metrics.stage("commit"):
+        db.session.commit()
+
+    for reply_token, msgs in replies:
+        try:
+            send_reply(reply_token, msgs)
+        except LineBotApiError as e:
+            _LOGGER_ROOT.exception(
+                "Got exception from LINE Messaging API", exc_info=e)
+    return failed
+
+
+@bp.route("/metrics", methods=["GET"])
+def show_metrics() -> ResponseReturnValue:
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        abort(401)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @bp.route("/show-fsm", methods=["GET"])
 def show_fsm() -> ResponseReturnValue:
-    return send_file("img/show-fsm.png", mimetype="image/png")
-
-
-def draw_fsm(path: str, model_mnger: AbstractContextManager) -> None:
-    with model_mnger as model:
-        model.get_graph().draw(path, prog="dot", format="png")
+    return assets.image_assets.send("show-fsm.png")
 
 
 def _init() -> None:
     """ Codes to run when app.run() is invoked. """
-    file.mkdir(tmp_dir)
     file.mkdir(_url_to_path("img"))
 
     def tasks_async() -> None:
         """ Async tasks to run without blocking. """
+        # draw the FSM diagrams whose machines have changed
+        diagram.draw_all()
         # prepare the images for serving
         shutil.copytree("img", _url_to_path("img"), dirs_exist_ok=True)
-        img = {
-            "main": "img/show-fsm.png",
-            "lexer": "img/show-fsm-lexer.png",
-            "parser": "img/show-fsm-parser.png",
-        }
-        # draw the FSM diagrams
-        draw_fsm(img["main"], machine_ctx_mnger(world_machine, WorldModel()))
-        draw_fsm(img["lexer"], parse._LexModel())
-        draw_fsm(img["parser"], parse._ParseModel())
-        for f in img.values():
-            shutil.copy2(f, _url_to_path("img"))
 
     mp.Process(target=tasks_async, daemon=True).start()
 
 
 @bp.before_request
 def before_request() -> Optional[ResponseReturnValue]:
-    if not request.is_secure:
-        # For ngrok
-        fg.rqst_url = request.url.replace("http://", "https://", 1)
-        fg.rqst_root_url = (
-            request.root_url.replace('http://', 'https://', 1).rstrip('/'))
+    # For ngrok; also set for secure requests, which the handlers rely on
+    fg.rqst_url = request.url.replace("http://", "https://", 1)
+    fg.rqst_root_url = (
+        request.root_url.replace('http://', 'https://', 1).rstrip('/'))
 
 
 @bp.route("/<path:path>")
 def send_static_content(path: str) -> ResponseReturnValue:
-    return send_from_directory("static", path, request.environ)
+    dir, name = os.path.split(path)
+    if dir == tmp_url:
+        tmp_store.touch(name)
+    return assets.static_assets.send(path)
+
+
+def _sign(body: str, secret: Optional[str] = None) -> str:
+    """ Return the signature of `body` as LINE would sign it
+        with `secret` (default: `channel_secret`).
+    """
+    secret = secret if secret is not None else channel_secret
+    digest = hmac.new(secret.encode("utf-8"),
+                      body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def _parse_event(event: Dict[str, Any]) -> Optional[Event]:
+    """ Return the raw webhook `event` parsed,
+        or `None` if it is not a message event, which the bot does not handle.
+    """
+    if event.get("type") != "message":
+        return None
+    return MessageEvent.new_from_json_dict(event)
+
+
+def handle_queued(app: Flask, events: List[QueuedEvent]) -> List[QueuedEvent]:
+    """ Handle the queued `events`, validated when queued,
+        in a request context for the public URL of the app.
+        Return the queued events which are not handled due to errors.
+    """
+    parsed = [(ev, _parse_event(ev.event)) for ev in events]
+    base_url = os.getenv("APP_BASE_URL", "https://localhost").rstrip("/")
+    with app.test_request_context(
+            "/callback", method="POST", base_url=base_url):
+        fg.rqst_url = f"{base_url}/callback"
+        fg.rqst_root_url = base_url
+        failed = {id(event) for event in dispatch_events(
+            [event for _, event in parsed if event is not None])}
+    return [ev for ev, event in parsed
+            if event is not None and id(event) in failed]
+
+
+def run_worker(app: Flask, worker: Optional[str] = None) -> None:
+    """ Handle the events in `webhook_queue` forever. """
+    if webhook_queue is None:
+        _LOGGER_ROOT.critical("Specify WEBHOOK_QUEUE as environment variable.")
+        sys.exit(1)
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    poll_interval = float(os.getenv("WEBHOOK_QUEUE_POLL", 0.5))
+    batch_size = int(os.getenv("WEBHOOK_QUEUE_BATCH", 100))
+    stale_timeout = float(os.getenv("WEBHOOK_QUEUE_STALE", 300))
+    max_attempts = int(os.getenv("WEBHOOK_QUEUE_ATTEMPTS", 3))
+    _LOGGER_ROOT.info(f"Worker {worker} consuming {webhook_queue.path}")
+    while True:
+        webhook_queue.release_stale(stale_timeout)
+        events = webhook_queue.claim(worker, batch_size)
+        if not events:
+            time.sleep(poll_interval)
+            continue
+        try:
+            failed = handle_queued(app, events)
+        except Exception as e:
+            _LOGGER_ROOT.exception(
+                f"Failed to handle {len(events)} queued events", exc_info=e)
+            failed = events
+        # release the failed events to be retried until out of attempts
+        retried = {ev.id for ev in failed if ev.attempts + 1 < max_attempts}
+        for ev in failed:
+            if ev.id not in retried:
+                _LOGGER_ROOT.error(
+                    f"Dropped event {ev.id} of user {ev.user_id}"
+                    f" after {ev.attempts + 1} attempts: {json.dumps(ev.event)}")
+        webhook_queue.release(retried)
+        webhook_queue.ack(ev.id for ev in events if ev.id not in retried)
+        _queued_events.inc("handled", value=len(events) - len(failed))
+        _queued_events.inc("retried", value=len(retried))
+        _queued_events.inc("dropped", value=len(failed) - len(retried))
+
 
 def main(app: Flask) -> None:
     port = int(os.environ.get("PORT", 8000))
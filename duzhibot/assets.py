@@ -0,0 +1,211 @@
+""" assets
+    Serving static files with validators, long-lived caching for
+    content-hashed URLs, precompressed variants, and an in-memory cache.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import stat
+import threading
+from datetime import datetime, timezone
+from typing import Dict, NamedTuple, Optional, OrderedDict, Tuple
+
+from flask import request, send_file
+from flask.wrappers import Response
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+import metrics
+
+max_cached_file = int(os.getenv("ASSET_CACHE_MAX_FILE", 256 * 1024))
+""" The max size in bytes of a file to be kept in memory. """
+
+cache_budget = int(os.getenv("ASSET_CACHE_SIZE", 16 * 1024 * 1024))
+""" The max total size in bytes of the files kept in memory. """
+
+immutable_max_age = 365 * 24 * 60 * 60
+""" The max age in seconds for the URLs with the content hash. """
+
+_compressible = ("text/", "application/json", "application/javascript", "image/svg+xml")
+_min_gain = 0.9  # Keep a compressed variant only if it is at most 90% in size
+
+Asset = NamedTuple(
+    "Asset", path=str, mtime_ns=int, size=int, mimetype=str, digest=str,
+    data=Optional[bytes], gzip_data=Optional[bytes], gzip_path=Optional[str],
+)
+
+
+def _is_compressible(mimetype: str) -> bool:
+    return mimetype.startswith(_compressible)
+
+
+def _file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def load_asset(path: str, st: os.stat_result) -> Asset:
+    """ Return the asset at `path` with the status `st`,
+        with its contents if it is small enough.
+    """
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    data = gzip_data = gzip_path = None
+    if st.st_size <= max_cached_file:
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        if _is_compressible(mimetype):
+            comp = gzip.compress(data, 9, mtime=0)
+            if len(comp) <= _min_gain * len(data):
+                gzip_data = comp
+    else:
+        digest = _file_digest(path)
+        if _is_compressible(mimetype):
+            try:
+                # a precompressed variant by e.g. `gzip -k`
+                if os.stat(f"{path}.gz").st_mtime_ns >= st.st_mtime_ns:
+                    gzip_path = f"{path}.gz"
+            except OSError:
+                pass
+    return Asset(path, st.st_mtime_ns, st.st_size, mimetype, digest,
+                 data, gzip_data, gzip_path)
+
+
+class AssetStore:
+    """ The files under the directory `root`,
+        with the small ones kept in a bounded LRU cache.
+        Changed files are detected by their modification times and sizes.
+    """
+    root: str
+    hits: int
+    misses: int
+    _entries: OrderedDict[str, Asset]
+    _cached_size: int
+    _lock: threading.Lock
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._cached_size = 0
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[Asset]:
+        """ Return the asset at the relative URL `url` if it is a file. """
+        path = safe_join(self.root, url)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            with self._lock:
+                self._put(path, None)
+            return None
+        with self._lock:
+            res = self._entries.get(path)
+            if (res is not None and res.mtime_ns == st.st_mtime_ns
+                    and res.size == st.st_size):
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return res
+        res = load_asset(path, st)
+        with self._lock:
+            self.misses += 1
+            self._put(path, res)
+        return res
+
+    def _put(self, path: str, asset: Optional[Asset]) -> None:
+        """ Cache `asset` for `path`, or remove the entry if `asset` is `None`. """
+        old = self._entries.pop(path, None)
+        if old is not None:
+            self._cached_size -= len(old.data or b"") + len(old.gzip_data or b"")
+        if asset is None:
+            return
+        self._entries[path] = asset
+        self._cached_size += len(asset.data or b"") + len(asset.gzip_data or b"")
+        while self._cached_size > cache_budget and len(self._entries) > 1:
+            _, old = self._entries.popitem(last=False)
+            self._cached_size -= len(old.data or b"") + len(old.gzip_data or b"")
+
+    def url(self, url: str) -> str:
+        """ Return the relative URL `url` with the content hash of the asset
+            appended for caching it for long.
+        """
+        asset = self.get(url)
+        return f"{url}?v={asset.digest}" if asset is not None else url
+
+    def send(self, url: str) -> Response:
+        """ Return a response of the asset at the relative URL `url`
+            for the current request.
+        """
+        asset = self.get(url)
+        if asset is None:
+            raise NotFound()
+
+        has_gzip = asset.gzip_data is not None or asset.gzip_path is not None
+        gzipped = has_gzip and "gzip" in request.accept_encodings
+        etag = f"{asset.digest}-gz" if gzipped else asset.digest
+        last_modified = datetime.fromtimestamp(
+            asset.mtime_ns // 1_000_000_000, timezone.utc)
+        if asset.data is not None:
+            res = Response(asset.gzip_data if gzipped else asset.data,
+                           mimetype=asset.mimetype)
+            res.set_etag(etag)
+            res.last_modified = last_modified
+            res.make_conditional(request, accept_ranges=not gzipped,
+                                 complete_length=None if gzipped else asset.size)
+        else:
+            # Let the WSGI server send the file with `sendfile()` if supported
+            res = send_file(os.path.abspath(asset.gzip_path if gzipped else asset.path),
+                            mimetype=asset.mimetype, conditional=True, etag=etag,
+                            last_modified=last_modified)
+        if gzipped:
+            res.content_encoding = "gzip"
+        if has_gzip:
+            res.vary.add("Accept-Encoding")
+
+        if request.args.get("v") == asset.digest:
+            res.cache_control.public = True
+            res.cache_control.max_age = immutable_max_age
+            res.cache_control.immutable = True
+        else:
+            res.cache_control.max_age = None
+            res.cache_control.no_cache = True
+        return res
+
+    def stats(self) -> Dict[str, int]:
+        """ Return the size and the counters of the cache. """
+        return {
+            "entries": len(self._entries),
+            "bytes": self._cached_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+static_assets = AssetStore("static")
+""" The files served at the root URL. """
+
+image_assets = AssetStore("img")
+""" The images in the repository, such as the FSM diagrams. """
+
+
+def _stats() -> Dict[Tuple[str, ...], float]:
+    return {(store, k): v
+            for store, s in [("static", static_assets), ("img", image_assets)]
+            for k, v in s.stats().items()}
+
+
+metrics.stats_metrics(
+    "duzhibot_asset_cache", "The size of the static file caches",
+    _stats, {
+        "hits": "Static files served from the caches",
+        "misses": "Static files read into the caches",
+    }, ["store", "stat"])
@@ -0,0 +1,748 @@
+""" bench
+    Benchmarks for comparing the performance of the implementations.
+
+    Usage: python -m duzhibot.bench [-o output.json] [benchmark...]
+           python -m duzhibot.bench --compare base.json head.json
+"""
+
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from types import MappingProxyType, ModuleType
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Tuple)
+
+import linebot.models as lm
+
+import parse
+
+Bench_t = Callable[[], Dict[str, Any]]
+
+corpus_msgs = [
+    "/help",
+    "go back",
+    "go to door",
+    "Go  To  'desk",
+    'go to "the room"',
+    "go back now",
+    "  go\n  to\n  lobby\n",
+    "hello world!",
+    "這不是命令",
+]
+""" Short messages which resemble the real chat traffic. """
+corpus_long = [
+    'go to "door" /cmd \'quoted\n  indented\ttext ' * 200,
+    " \t" * 2000 + "\n" * 2000,
+    '"' + "\\\"" * 2000 + '"suffix',
+]
+""" Long messages which resemble spam pastes. """
+corpus_adversarial = [
+    "'" * 500,
+    '"' * 501,
+    "\\" * 1000 + '"',
+    "/" * 1000,
+    "go " * 1000 + "to",
+    "\u3000\t \r\n" * 500,
+    "".join(map(chr, range(0x20))) * 30,
+    "🐍" * 1000,
+    " ".join(f"'{k}" for k in range(500)),
+]
+""" Messages which target the corner cases of the lexer and the parser. """
+
+
+def _time(f: Callable[[], Any], number: int, repeat: int = 5) -> float:
+    """ Return the best time in seconds per call of `f`. """
+    return min(timeit.repeat(f, number=number, repeat=repeat)) / number
+
+
+def _compare(
+    impls: Dict[str, Callable[[str], Any]], texts: Iterable[str], number: int,
+) -> Dict[str, Any]:
+    """ Return the timing of each of `impls` on `texts`
+        after checking that all of them give the same results.
+    """
+    texts = list(texts)
+    expected = [impls["fsm"](t) for t in texts]
+    for name, f in impls.items():
+        assert [f(t) for t in texts] == expected, f"'{name}' disagrees"
+    return {
+        name: _time(lambda: [f(t) for t in texts], number)
+        for name, f in impls.items()
+    }
+
+
+def bench_lex() -> Dict[str, Any]:
+    def run(f: Callable[[str], Any]) -> Callable[[str], Any]:
+        return lambda t: list(f(t))
+    impls = {"fsm": run(parse.lex_fsm), "compiled": run(parse.lex)}
+    return {
+        "short": _compare(impls, corpus_msgs, 200),
+        "long": _compare(impls, corpus_long, 5),
+        "adversarial": _compare(impls, corpus_adversarial, 5),
+    }
+
+
+def bench_parse() -> Dict[str, Any]:
+    def thaw(res: parse.ParseRes_t) -> Any:
+        cmd, args, kwargs = res
+        return cmd, list(args), dict(kwargs)
+    impls = {
+        "fsm": parse.parse_fsm,
+        "table": parse.parse_tbl,
+        "cached": lambda t: thaw(parse.parse(t)),
+    }
+    return {
+        "short": _compare(impls, corpus_msgs, 50),
+        "long": _compare(impls, corpus_long, 2),
+        "adversarial": _compare(impls, corpus_adversarial, 2),
+        "cache": parse.parse_cache.stats(),
+    }
+
+
+def _stub_app() -> Tuple[ModuleType, Any]:
+    """ Return (the app module, a new app) which use a temporary SQLite database
+        and record the replies instead of sending them.
+    """
+    tmp = tempfile.mkdtemp(prefix="duzhibot-bench-")
+    os.environ.setdefault("LINE_CHANNEL_SECRET", "bench")
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+    # wait longer than by default for the locks held by the other threads
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}?timeout=60"
+    import duzhibot.app as app_mod
+    app = app_mod.App(app_mod.__name__)
+    app.register_blueprint(app_mod.bp)
+    app_mod.line_bot_api.reply_message = lambda *args, **kwargs: None
+    with app.app_context():
+        app_mod.db.create_all()
+    return app_mod, app
+
+
+def _text_event(user_id: str, text: str, k: int = 0) -> lm.MessageEvent:
+    return lm.MessageEvent(
+        reply_token=f"{user_id}-{k}",
+        source=lm.SourceUser(user_id=user_id),
+        message=lm.TextMessage(id=str(k), text=text),
+        timestamp=0,
+        mode="active",
+    )
+
+
+def _handle_events(app_mod: ModuleType, app: Any, user_id: str, texts: List[str]) -> None:
+    """ Let the app handle `texts` sent by the user `user_id` in order. """
+    for k, text in enumerate(texts):
+        with app.test_request_context(
+                "/callback", method="POST", base_url="http://bench.invalid"):
+            app.preprocess_request()
+            app_mod.handle_text_message(_text_event(user_id, text, k))
+
+
+def _user_states(app_mod: ModuleType, app: Any) -> Dict[str, str]:
+    with app.app_context():
+        import db
+        return {u.user_id: u.state for u in app_mod.db.session.query(db._User)}
+
+
+_drawer_script = [
+    ("room_on__desk__drawer__try0", None),
+    *(("cmd_input", {"input": "0"}) for _ in range(3)),
+    ("λ", {}),
+    ("λ", {}),
+]
+_drawer_final = "hell__fini"
+
+
+def _run_drawer_script() -> str:
+    """ Drive a pooled world model through `_drawer_script`
+        and return its final state.
+    """
+    import fsm
+    (initial, _), *steps = _drawer_script
+    with fsm.world_models(initial) as model:
+        for trigger, kwargs in steps:
+            model.trigger(trigger, event=None, reply=lambda msg: None,
+                          **(kwargs or {}))
+        return model.state
+
+
+Step_t = Tuple[str, Tuple, Dict[str, Any]]
+
+_exit_triggers = frozenset(["resuscitate"])
+""" The triggers other than the user commands which lead out of an area,
+    without which the playthroughs from the area end at once.
+"""
+
+
+def _step_choices(state: str) -> List[Step_t]:
+    """ Return the commands with their arguments
+        which may trigger a transition from `state` of the world machine.
+    """
+    import fsm
+    import world_rules
+    res = []
+    for trigger in sorted(fsm.world_triggers[state].triggers):
+        if not trigger.startswith("cmd_") and trigger not in _exit_triggers:
+            continue
+        dsts = {
+            c.func.args[0]
+            for t in fsm.world_machine.get_nested_transitions(
+                trigger, src_path=state.split("__"))
+            for c in t.conditions
+            if getattr(c.func, "func", None)
+            in (world_rules.is_dst, world_rules.check_body_temperature)
+        }
+        if dsts:
+            # Skip the resetter which ends the game from anywhere
+            dsts.discard("hell")
+            if not dsts:
+                continue
+        for dst in sorted(dsts) or [""]:
+            for pw in ["0", world_rules.DRAWER_PW] if trigger == "cmd_input" else [""]:
+                res.append((trigger, ("world",), {
+                    "dst": dst, "input": pw, "nick": "bench", "cmd_name": "/hello",
+                }))
+    return res
+
+
+@contextmanager
+def _area_model(area: str, seed: int) -> Iterator[Any]:
+    """ Return a context manager which provides a pooled world model
+        entered into `area` and seeds the random number generator.
+    """
+    import fsm
+    import world
+    import world_rules
+    from fsm_utils import resolve_initial
+    random.seed(seed)
+    with fsm.world_models(resolve_initial(world.doms_world[area], area)) as model:
+        if fsm.world_triggers[model.state].lambda_only:
+            model.exec_cmd(world_rules.trig_lambda, (), {}, None, lambda msg: None)
+        yield model
+
+
+def _playthrough(area: str, n_steps: int, seed: int) -> List[List[Step_t]]:
+    """ Return scripts of `n_steps` random commands in total
+        which walk the world machine from the initial state of `area`,
+        each until no more commands are available.
+    """
+    rng = random.Random(seed)
+    res: List[List[Step_t]] = []
+    n = 0
+    while n < n_steps:
+        script: List[Step_t] = []
+        with _area_model(area, seed + len(res)) as model:
+            while n < n_steps:
+                choices = _step_choices(model.state)
+                if not choices:
+                    break
+                step = rng.choice(choices)
+                script.append(step)
+                n += 1
+                try:
+                    model.exec_cmd(*step, None, lambda msg: None)
+                except Exception:
+                    break  # Counted when replayed
+        if not script:
+            break
+        res.append(script)
+    return res
+
+
+def _replay(area: str, scripts: List[List[Step_t]], seed: int) -> Dict[str, Any]:
+    """ Drive pooled world models through `scripts`
+        from the initial state of `area` and return the statistics.
+    """
+    visited = set()
+    accepted = errors = 0
+    for k, script in enumerate(scripts):
+        with _area_model(area, seed + k) as model:
+            visited.add(model.state)
+            for step in script:
+                try:
+                    accepted += bool(model.exec_cmd(*step, None, lambda msg: None))
+                except Exception:
+                    errors += 1
+                visited.add(model.state)
+    return {"accepted": accepted, "errors": errors, "visited": len(visited)}
+
+
+def _user_script(n_steps: int, seed: int) -> List[Step_t]:
+    """ Return a script of up to `n_steps` random commands which walk
+        the world machine from its initial state, cut before the first command
+        which fails or uses the random number generator,
+        so that replaying the script always ends in the same state.
+    """
+    import fsm
+    rng = random.Random(seed)
+    res: List[Step_t] = []
+    with fsm.world_models(fsm.world_initial) as model:
+        while len(res) < n_steps:
+            choices = _step_choices(model.state)
+            if not choices:
+                break
+            step = rng.choice(choices)
+            before = random.getstate()
+            try:
+                model.exec_cmd(*step, None, lambda msg: None)
+            except Exception:
+                break
+            if random.getstate() != before:
+                break
+            res.append(step)
+    return res
+
+
+_step_prefix = "/bench-step "
+
+
+@contextmanager
+def _parse_steps(steps: List[Step_t]) -> Iterator[Callable[[int], str]]:
+    """ Return a context manager which lets the texts from the `as` function
+        for the index of a command in `steps` parse as the command,
+        as no text parses to a command of the world machine yet.
+    """
+    parse_text = parse.parse
+
+    def parse_step(text: str) -> parse.ParseRes_t:
+        if text.startswith(_step_prefix):
+            cmd, args, kwargs = steps[int(text[len(_step_prefix):])]
+            return cmd, args, MappingProxyType(kwargs)
+        return parse_text(text)
+    parse.parse = parse_step
+    try:
+        yield lambda k: f"{_step_prefix}{k}"
+    finally:
+        parse.parse = parse_text
+
+
+def _user_texts(
+    n_users: int, n_msgs: int, step_text: Callable[[int], str], steps: List[Step_t],
+) -> Dict[str, List[str]]:
+    """ Return `n_msgs` texts for each of `n_users` users,
+        alternating the chat messages and the commands of a script
+        appended to `steps`, and then only chat messages after the script ends.
+    """
+    res = {}
+    for k in range(n_users):
+        texts = []
+        for m, step in enumerate(_user_script(n_msgs // 2, k)):
+            texts.append(corpus_msgs[(k + m) % len(corpus_msgs)])
+            texts.append(step_text(len(steps)))
+            steps.append(step)
+        while len(texts) < n_msgs:
+            texts.append(corpus_msgs[(k + len(texts)) % len(corpus_msgs)])
+        res[f"U{k:032x}"] = texts
+    return res
+
+
+def bench_concurrent(
+    n_users: int = 100, n_msgs: int = 50, n_threads: int = 8,
+) -> Dict[str, Any]:
+    """ Fire simulated text message events of many users concurrently,
+        which move the users through the world machine,
+        and check that every final state is the same as the sequential run.
+    """
+    import fsm
+    steps: List[Step_t] = []
+    res: Dict[str, Any] = {}
+    states = {}
+    with _parse_steps(steps) as step_text:
+        scripts = _user_texts(n_users, n_msgs, step_text, steps)
+        for name, workers in [("sequential", 1), ("threaded", n_threads)]:
+            app_mod, app = _stub_app()
+
+            def run() -> None:
+                with ThreadPoolExecutor(workers) as ex:
+                    for f in [ex.submit(_handle_events, app_mod, app, user_id, texts)
+                              for user_id, texts in scripts.items()]:
+                        f.result()
+            res[name] = _time(run, 1, 1)
+            states[name] = _user_states(app_mod, app)
+    assert len(states["sequential"]) == n_users, "missing users"
+    assert all(v != fsm.world_initial for v in states["sequential"].values()), \
+        "users not moved"
+    assert states["threaded"] == states["sequential"], "inconsistent states"
+
+    with ThreadPoolExecutor(n_threads) as ex:
+        finals = list(ex.map(lambda _: _run_drawer_script(), range(n_users * 20)))
+    assert all(s == _drawer_final for s in finals), "inconsistent FSM runs"
+
+    res["events"] = sum(map(len, scripts.values()))
+    assert res["events"] == n_users * n_msgs, "missing events"
+    res["commands"] = len(steps)
+    res["states"] = len(set(states["sequential"].values()))
+    return res
+
+
+def bench_exec(n_steps: int = 500, seed: int = 0) -> Dict[str, Any]:
+    """ Drive the world machine through seeded random playthroughs
+        starting from every area of `world.doms_world`.
+    """
+    import world
+    res: Dict[str, Any] = {}
+    for area in world.doms_world.keys():
+        scripts = _playthrough(area, n_steps, seed)
+        stats = _replay(area, scripts, seed)
+        assert _replay(area, scripts, seed) == stats, f"'{area}' is nondeterministic"
+        steps = sum(map(len, scripts))
+        assert steps > 0, f"'{area}' has no playthroughs"
+        res[area] = {
+            "per_step": _time(lambda: _replay(area, scripts, seed), 1) / max(steps, 1),
+            "steps": steps,
+            "playthroughs": len(scripts),
+            **stats,
+        }
+    return res
+
+
+def _callback_bodies(
+    app_mod: ModuleType, scripts: Dict[str, List[str]], batch_size: int,
+) -> List[Tuple[str, str]]:
+    """ Return (body, signature) of webhook requests carrying the texts
+        in `scripts` of each user in order, interleaving the users,
+        with up to `batch_size` events per body.
+    """
+    n_msgs = max(map(len, scripts.values()), default=0)
+    events = [
+        _text_event(user_id, texts[m], m).as_json_dict()
+        for m in range(n_msgs) for user_id, texts in scripts.items() if m < len(texts)
+    ]
+    res = []
+    for k in range(0, len(events), batch_size):
+        body = json.dumps({"destination": "Ubench", "events": events[k:k + batch_size]})
+        res.append((body, app_mod._sign(body)))
+    return res
+
+
+def bench_callback(
+    n_users: int = 20, n_msgs: int = 20, batch_size: int = 5,
+) -> Dict[str, Any]:
+    """ Post signed webhook bodies of text message events, which move the users
+        through the world machine, to `/callback`,
+        measure the events handled per second,
+        and check that handling the events one by one and as batches
+        give the same final states.
+    """
+    import fsm
+    steps: List[Step_t] = []
+    res: Dict[str, Any] = {}
+    states = {}
+    with _parse_steps(steps) as step_text:
+        scripts = _user_texts(n_users, n_msgs, step_text, steps)
+        n_events = sum(map(len, scripts.values()))
+        for name, webhook_batch in [("inline", False), ("batch", True)]:
+            app_mod, app = _stub_app()
+            client = app.test_client()
+            bodies = _callback_bodies(app_mod, scripts, batch_size)
+            batch = app_mod.webhook_batch
+            app_mod.webhook_batch = webhook_batch
+            try:
+                def run() -> None:
+                    for body, signature in bodies:
+                        resp = client.post(
+                            "/callback", data=body, base_url="http://bench.invalid",
+                            headers={"X-Line-Signature": signature,
+                                     "Content-Type": "application/json"})
+                        assert resp.status_code == 200, resp.status_code
+                sec = _time(run, 1, 1)
+            finally:
+                app_mod.webhook_batch = batch
+            res[name] = {"seconds": sec, "events_per_sec": n_events / sec}
+            states[name] = _user_states(app_mod, app)
+    assert len(states["inline"]) == n_users, "missing users"
+    assert all(v != fsm.world_initial for v in states["inline"].values()), \
+        "users not moved"
+    assert states["batch"] == states["inline"], "inconsistent states"
+
+    res.update({"events": n_events, "requests": len(bodies),
+                "states": len(set(states["inline"].values()))})
+    return res
+
+
+def _synthetic_world(n_areas: int, width: int = 4, depth: int = 3) -> Dict[str, Any]:
+    """ Return a world config of `n_areas` areas, each a tree of states
+        `width` states wide and `depth` levels deep under its initial state.
+    """
+    def tree(name: str, level: int) -> Any:
+        if level == depth:
+            return name
+        return {
+            "name": name,
+            "states": [tree(f"s{k}", level + 1) for k in range(width)],
+            "initial": "s0",
+        }
+    return {
+        "name": "world",
+        "states": [{**tree(f"area{k}", 0), "initial": "s0__s0"}
+                   for k in range(n_areas)],
+        "transitions": [],
+        "initial": "area0",
+    }
+
+
+def _build_synthetic_world(n_areas: int) -> int:
+    """ Build a synthetic world with the helpers used by `world`
+        and return the number of its states.
+    """
+    from fsm_utils import (ConfigIndex, add_resetters, get_state_names,
+                           ignore_transitions, resolve_initial)
+    config = _synthetic_world(n_areas)
+    for area in config["states"]:
+        for dom in area["states"]:
+            config["transitions"].append(
+                ["cmd_reach", resolve_initial(area, area["name"]),
+                 resolve_initial(dom, f"{area['name']}__{dom['name']}")])
+    excl = set(get_state_names(config["states"][0], base="area0"))
+    index = ConfigIndex(config)
+    for trigger in ["cmd_hell", "kill", "force_kill"]:
+        add_resetters(config, [trigger], resolve_initial(config, index=index),
+                      excl=excl, index=index)
+    ignore_transitions(config, ["TSpace"], "=", index=index)
+    return len(index.paths)
+
+
+def bench_config(sizes: Iterable[int] = (25, 50, 100, 200)) -> Dict[str, Any]:
+    """ Time building synthetic worlds of growing sizes
+        to check that the time per state stays about the same.
+    """
+    res: Dict[str, Any] = {}
+    for n_areas in sizes:
+        n_states = _build_synthetic_world(n_areas)
+        sec = _time(lambda: _build_synthetic_world(n_areas), 1, 3)
+        res[str(n_states)] = {"seconds": sec, "per_state": sec / n_states}
+    return res
+
+
+@contextmanager
+def _count_statements(engine: Any) -> Iterator[List[str]]:
+    """ Return a context manager which provides a list
+        collecting the SQL statements executed with `engine`.
+    """
+    from sqlalchemy import event
+    res: List[str] = []
+
+    def f(conn: Any, cursor: Any, statement: str, *args: Any) -> None:
+        res.append(statement)
+    event.listen(engine, "before_cursor_execute", f)
+    try:
+        yield res
+    finally:
+        event.remove(engine, "before_cursor_execute", f)
+
+
+def bench_db() -> Dict[str, Any]:
+    """ Count the SQL statements per user load and save.
+        The behavior is checked by `tests/test_db.py` instead.
+    """
+    app_mod, app = _stub_app()
+    import db
+    import fsm
+    res: Dict[str, Any] = {}
+    with app.app_context():
+        engine = app_mod.db.get_engine()
+
+        def load_save(name: str, user_id: str, state: str) -> None:
+            with _count_statements(engine) as stmts:
+                user = db.User.from_user_id(user_id)
+                with user.load_machine_model() as model:
+                    fsm.world_machine.set_state(state, model)
+                    user.save_machine_model(model)
+            res[name] = {"statements": len(stmts), "sql": stmts}
+        load_save("new", "U0", "init__registered")
+        load_save("existing", "U0", "room_off__init")
+        load_save("unchanged", "U0", "room_off__init")
+
+        # Write behind
+        db.state_cache = db.StateCache(app, flush_interval=60)
+        try:
+            load_save("cached_load", "U0", "lobby__init")
+            load_save("cached", "U0", "lobby__clock")
+            with _count_statements(engine) as stmts:
+                db.state_cache.flush()
+            res["cached_flush"] = {"statements": len(stmts), "sql": stmts}
+        finally:
+            db.state_cache = None
+    return res
+
+
+@contextmanager
+def _stub_line_api(statuses: Dict[str, List[int]]) -> Iterator[Tuple[str, Dict[str, int]]]:
+    """ Return a context manager which provides (the endpoint of a local stub
+        of the LINE Messaging API, the number of requests for each reply token).
+        The replies with a token in `statuses` get the listed statuses in turn,
+        repeating the last one, and the others succeed.
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    counts: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            token = body.get("replyToken", "")
+            with lock:
+                k = counts[token] = counts.get(token, 0) + 1
+            seq = statuses.get(token, [200])
+            status = seq[min(k, len(seq)) - 1]
+            data = b"{}" if status == 200 else b'{"message": "stub"}'
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    th = threading.Thread(target=server.serve_forever, daemon=True)
+    th.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}", counts
+    finally:
+        server.shutdown()
+        th.join()
+
+
+def bench_reply(n_replies: int = 200, deadline: float = 1.0) -> Dict[str, Any]:
+    """ Reply through `ReplySender` to a local stub of the LINE Messaging API,
+        as set with `LINE_API_ENDPOINT`, and check the retries and the deadline.
+    """
+    from linebot import LineBotApi
+
+    from reply import ReplySender, SessionHttpClient
+    msgs = [lm.TextSendMessage(text="bench")]
+    statuses = {"flaky": [503, 503, 200], "down": [500], "bad": [400]}
+    res: Dict[str, Any] = {}
+    with _stub_line_api(statuses) as (endpoint, counts):
+        api = LineBotApi("bench", endpoint=endpoint,
+                         http_client=partial(SessionHttpClient, pool_size=4))
+        sender = ReplySender(api, workers=4, deadline=deadline, backoff=0.05)
+        sender.start()
+        beg = time.perf_counter()
+        for k in range(n_replies):
+            sender.submit(f"ok{k}", msgs)
+        for token in statuses.keys():
+            sender.submit(token, msgs)
+        sender.stop()
+        res["seconds"] = time.perf_counter() - beg
+        res.update(sender.stats())
+        assert sender.sent == n_replies + 1, "replies not sent"
+        assert counts["flaky"] == 3, "transient errors not retried"
+        assert counts["bad"] == 1, "permanent error retried"
+        assert sender.expired == 1 and res["seconds"] >= deadline, "deadline not kept"
+
+        # Replied in the caller with a single attempt once the queue is full
+        sender = ReplySender(api, workers=0, max_queue=1, deadline=deadline)
+        statuses["down-inline"] = [500]
+        sender.submit("ok", msgs)
+        beg = time.perf_counter()
+        sender.submit("down-inline", msgs)
+        res["overflowed_seconds"] = time.perf_counter() - beg
+        assert sender.overflowed == 1 and sender.failed == 1, "overflow not failed"
+        assert counts["down-inline"] == 1, "overflow retried"
+    return res
+
+
+benchmarks: Dict[str, Bench_t] = {
+    "db": bench_db,
+    "lex": bench_lex,
+    "parse": bench_parse,
+    "exec": bench_exec,
+    "config": bench_config,
+    "callback": bench_callback,
+    "concurrent": bench_concurrent,
+    "reply": bench_reply,
+}
+
+
+def _git_commit() -> Optional[str]:
+    """ Return the checked out commit with a `+` appended if modified. """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=cwd, capture_output=True,
+            text=True, check=True).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=cwd,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}+" if dirty else commit
+
+
+def metadata() -> Dict[str, Any]:
+    """ Return the environment of the benchmark run. """
+    import sqlalchemy
+    import transitions
+    return {
+        "commit": _git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "transitions": transitions.__version__,
+        "sqlalchemy": sqlalchemy.__version__,
+    }
+
+
+def _flatten(res: Any, prefix: str = "") -> Dict[str, float]:
+    """ Return the numbers in the nested dict `res` keyed by their paths. """
+    if isinstance(res, dict):
+        return {k: v for key, value in res.items()
+                for k, v in _flatten(value, f"{prefix}{key}/").items()}
+    if isinstance(res, (int, float)) and not isinstance(res, bool):
+        return {prefix[:-1]: res}
+    return {}
+
+
+def compare(base: Dict[str, Any], head: Dict[str, Any]) -> List[str]:
+    """ Return a line of the ratio of `head` to `base`
+        for every number in both of the results.
+    """
+    base_flat = _flatten(base["results"])
+    head_flat = _flatten(head["results"])
+    res = [f"base: {base['meta'].get('commit')}", f"head: {head['meta'].get('commit')}"]
+    for k, v in head_flat.items():
+        if k in base_flat:
+            ratio = f"{v / base_flat[k]:8.3f}x" if base_flat[k] else " " * 9
+            res.append(f"{ratio}  {k}: {base_flat[k]:.6g} -> {v:.6g}")
+    return res
+
+
+def _load(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv: List[str]) -> None:
+    if argv[:1] == ["--compare"]:
+        base, head = map(_load, argv[1:3])
+        print("\n".join(compare(base, head)))
+        return
+    output = None
+    if argv[:1] in (["-o"], ["--output"]):
+        output, argv = argv[1], argv[2:]
+    names = argv or list(benchmarks.keys())
+    res = {
+        "meta": metadata(),
+        "results": {name: benchmarks[name]() for name in names},
+    }
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(res, f, indent=2)
+    json.dump(res, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,25 +1,159 @@
-from contextlib import suppress
-from typing import Any, NamedTuple, Type, cast
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from typing import (Any, Dict, Iterable, Iterator, NamedTuple,
+                    Optional, OrderedDict, Type, cast)
 
+from flask import Flask, has_app_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import load_only
-from sqlalchemy.orm.exc import NoResultFound, ObjectDeletedError
+from sqlalchemy import SmallInteger, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.types import TypeDecorator
 
-from fsm import WorldModel, world_initial
+import metrics
+import world_rules
+from fsm import (Profile, WorldModel, world_initial, world_models,
+                 world_state_names)
+from statecode import StateCodec, load_codes
 
-db = SQLAlchemy()
+_LOGGER = logging.getLogger(__name__)
+
+# Keep the loaded values after committing to avoid reloading them
+db = SQLAlchemy(session_options={"expire_on_commit": False})
+
+_conflicts = metrics.Counter(
+    "duzhibot_db_conflicts_total", "User states not saved due to concurrent modifications")
+_insufficient_wealth = metrics.Counter(
+    "duzhibot_db_insufficient_wealth_total",
+    "User states whose spending exceeds the wealth in the database")
+_state_cache_lookups = metrics.Counter(
+    "duzhibot_state_cache_lookups_total", "Lookups of the user state cache by results",
+    ["result"])
+_pool_wait = metrics.Histogram(
+    "duzhibot_db_pool_wait_seconds", "Seconds waited for a database connection from the pool")
+_pool_timeouts = metrics.Counter(
+    "duzhibot_db_pool_timeouts_total", "Database connections not available before the pool timeout")
+
+
+class InsufficientWealthError(Exception):
+    """ The wealth of a user in the database is less than the user spends,
+        as it is modified by others since loaded.
+    """
+
+
+class _TimedQueuePool(QueuePool):
+    """ A `QueuePool` which observes the seconds waited for connections. """
+
+    def _do_get(self) -> Any:
+        try:
+            with _pool_wait.time():
+                return super()._do_get()
+        except PoolTimeoutError:
+            _pool_timeouts.inc()
+            raise
+
+
+def engine_options(
+    database_url: str,
+    pool_size: int,
+    max_overflow: int = 0,
+    pool_timeout: float = 30,
+    pool_recycle: float = 1800,
+    statement_timeout: int = 0,
+    external_pooler: bool = False,
+) -> Dict[str, Any]:
+    """ Return the options of the engine for the database at `database_url`
+        with a pool of `pool_size` connections and `max_overflow` more at peak,
+        waiting for up to `pool_timeout` seconds for a connection
+        and replacing the connections older than `pool_recycle` seconds.
+        Statements running longer than `statement_timeout` milliseconds
+        are canceled by PostgreSQL if positive.
+        If `external_pooler` is `True`, connect through e.g. PgBouncer
+        without pooling connections in the process.
+    """
+    url = make_url(database_url)
+    if url.get_backend_name() == "sqlite":  # Pooled per thread by SQLAlchemy
+        return {}
+    res: Dict[str, Any] = {}
+    if external_pooler:
+        res["poolclass"] = NullPool
+    else:
+        res.update(
+            poolclass=_TimedQueuePool, pool_size=pool_size, max_overflow=max_overflow,
+            pool_timeout=pool_timeout, pool_recycle=pool_recycle,
+            # Replace the connections closed by the server without failing the request
+            pool_pre_ping=True)
+    if statement_timeout > 0 and url.get_backend_name() == "postgresql":
+        res["connect_args"] = {"options": f"-c statement_timeout={statement_timeout}"}
+    return res
+
+
+def pool_stats() -> Dict[str, int]:
+    """ Return the usage of the connection pool of the current app if pooled. """
+    if not has_app_context():
+        return {}
+    pool = db.get_engine().pool
+    if not isinstance(pool, QueuePool):
+        return {}
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(0, pool.overflow()),
+    }
+
+
+metrics.Gauge(
+    "duzhibot_db_pool", "The usage of the database connection pool",
+    lambda: {(k,): v for k, v in pool_stats().items()}, ["stat"])
+
+
+state_codec = StateCodec(
+    load_codes(), world_state_names, world_rules.state_invalid)
+""" The codes of the states stored in the database. """
+
+
+class StateCode(TypeDecorator):
+    """ A state name stored as its code by `state_codec`.
+        Invalid codes are loaded as `world_rules.state_invalid`.
+    """
+    impl = SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value: Optional[str], dialect: Any) -> Optional[int]:
+        return state_codec.encode(value) if value is not None else None
+
+    def process_result_value(self, value: Optional[int], dialect: Any) -> Optional[str]:
+        return state_codec.decode(value) if value is not None else None
 
 
 class _User(cast(Type, db.Model)):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Text, unique=True, nullable=False)
-    state = db.Column(db.Text, nullable=False)
+    state = db.Column("state_code", StateCode, key="state", nullable=False)
+    # The runtime attributes of `WorldModel`; JSONB for compactness if supported
+    attrs = db.Column(db.JSON(none_as_null=True).with_variant(
+        postgresql.JSONB(none_as_null=True), "postgresql"))
+    # The profile of `WorldModel`
+    nick = db.Column(db.Text)
+    wealth = db.Column(db.BigInteger, nullable=False)
 
 
 class _Data(NamedTuple):
     id: int
     user_id: str
     state: str
+    attrs: Optional[Dict[str, Any]]
+    nick: Optional[str]
+    wealth: int
 
     @classmethod
     def from_model(cls, model: "User") -> "_Data":
@@ -33,10 +167,12 @@ class _Data(NamedTuple):
 class User():
     _model: _User
     _before: _Data
+    _is_new: bool
 
-    def __init__(self, model: _User) -> None:
+    def __init__(self, model: _User, is_new: bool = False) -> None:
         self._model = model
         self._before = _Data.from_model(model)
+        self._is_new = is_new
 
     def __getattribute__(self, __name: str) -> Any:
         if __name in _Data._fields:
@@ -50,31 +186,360 @@ class User():
 
     @classmethod
     def from_user_id(cls, user_id: str) -> "User":
-        with suppress(NoResultFound, ObjectDeletedError):
-            return cls(db.session.query(_User)
-                       .options(load_only("user_id"))
-                       .filter_by(user_id=user_id).one())
-        # new user; add user (may fail due to race conditions; just raise)
-        with db.session.begin_nested():
-            res = cls(
-                _User(user_id=user_id, state=world_initial))
-            db.session.add(res._model)
+        return cls.from_user_ids([user_id])[user_id]
+
+    @classmethod
+    def from_user_ids(cls, user_ids: Iterable[str]) -> Dict[str, "User"]:
+        """ Return a dict of the users with the given `user_ids`
+            loaded with a single query and added if not existing.
+        """
+        res: Dict[str, User] = {}
+        missing = list(dict.fromkeys(user_ids))
+        if state_cache is not None:
+            for user_id in missing:
+                data = state_cache.get(user_id)
+                if data is not None:
+                    res[user_id] = cls(_User(**data._asdict()))
+            missing = [v for v in missing if v not in res]
+            _state_cache_lookups.inc("hit", value=len(res))
+            _state_cache_lookups.inc("miss", value=len(missing))
+        if not missing:
             return res
 
-    def load_machine_model(self) -> WorldModel:
-        return WorldModel(initial=self.state)
+        loaded = {
+            model.user_id: cls(model)
+            for model in db.session.query(_User)
+            .filter(_User.user_id.in_(missing))
+        }
+        for user_id in missing:
+            user = loaded.get(user_id)
+            if user is None:  # new user; add user
+                user = cls(_insert_user(user_id), is_new=True)
+            if state_cache is not None:
+                state_cache.add(user._before)
+            res[user_id] = user
+        return res
 
-    def save_machine_model(self, model: WorldModel) -> None:
-        try:
-            # verify
-            self._model = (
-                db.session.query(_User)
-                .filter_by(**self._before._asdict()).one())
-            # update
-            self._model.state = model.state
-            self._before = _Data.from_model(self._model)
+    @contextmanager
+    def load_machine_model(self) -> Iterator[WorldModel]:
+        """ Return a context manager which provides a pooled `WorldModel`
+            in the state and with the attributes and the profile of the user
+            as the `as` object.
+        """
+        # Validated by `StateCode` when loaded
+        with world_models(self.state) as model:
+            model.load_attrs(self.attrs)
+            model.profile = Profile(self.nick, self.wealth)
+            yield model
+
+    def _after(self, model: WorldModel) -> _Data:
+        return self._before._replace(
+            state=model.state, attrs=model.dump_attrs(),
+            nick=model.profile.nick, wealth=model.profile.wealth)
+
+    def is_changed(self, model: WorldModel) -> bool:
+        """ Return whether the state, the attributes, or the profile of `model`
+            differ from the loaded ones.
+        """
+        return self._after(model) != self._before
+
+    def save_machine_model(self, model: WorldModel, commit: bool = True) -> None:
+        """ Save the state, the attributes, and the profile of `model`
+            if they are changed, in a single statement.
+            Write behind with `state_cache` if it is enabled.
+            If `commit` is `False`, the caller should commit the session.
+            Raise `StaleDataError` if the state is modified by others since loaded,
+            or `InsufficientWealthError` if the wealth is too low for the spending.
+        """
+        after = self._after(model)
+        changed = after != self._before
+        if changed:
+            if state_cache is not None:
+                state_cache.put(self._before, after)
+            else:
+                try:
+                    updated = _update_user(self._before, after)
+                except InsufficientWealthError:
+                    _insufficient_wealth.inc()
+                    if commit:
+                        db.session.rollback()
+                    raise
+                if not updated:
+                    # failed due to race conditions
+                    _conflicts.inc()
+                    if commit:
+                        db.session.rollback()
+                    raise StaleDataError(
+                        f"User {self._before.user_id} was modified concurrently")
+            for k in ["state", "attrs", "nick", "wealth"]:
+                set_committed_value(self._model, k, getattr(after, k))
+            self._before = after
+        if commit and (self._is_new or (changed and state_cache is None)):
             db.session.commit()
-        except NoResultFound:
-            # failed due to race conditions
-            db.session.rollback()
+            self._is_new = False
+
+
+def _update_user(before: _Data, after: _Data) -> bool:
+    """ Update the user `before` to `after`, writing only the changed columns,
+        only if the state is not modified by others since `before` was loaded.
+        The wealth is changed by the difference atomically and kept non-negative.
+        Return whether the user is updated,
+        or raise `InsufficientWealthError` if the wealth is too low for the difference.
+
+        Only the state is checked for concurrent modifications;
+        the attributes and the nickname changed by others without changing the state
+        are overwritten by the last writer.
+    """
+    values: Dict[str, Any] = {k: getattr(after, k) for k in ["state", "attrs", "nick"]
+                              if getattr(after, k) != getattr(before, k)}
+    conds = [_User.id == before.id, _User.state == before.state]
+    delta = after.wealth - before.wealth
+    if delta:
+        values["wealth"] = _User.wealth + delta
+        if delta < 0:
+            conds.append(_User.wealth >= -delta)
+    res = db.session.execute(
+        update(_User)
+        .where(*conds)
+        .values(**values)
+        .execution_options(synchronize_session=False))
+    if res.rowcount == 1:
+        return True
+    if delta < 0:
+        # Tell the insufficient wealth from the modified state
+        row = db.session.execute(
+            select(_User.state, _User.wealth).where(_User.id == before.id)).first()
+        if row is not None and row.state == before.state:
+            raise InsufficientWealthError(
+                f"User {before.user_id} has wealth {row.wealth} but spends {-delta}")
+    return False
+
+
+class StateCache:
+    """ An in-process write-behind cache of user states.
+        Changed states are written in a batch by a background thread
+        every `flush_interval` seconds or once `batch_size` states are pending,
+        and all pending states are written on shutdown.
+        Up to `max_entries` written states are kept for loading.
+
+        Suitable only if all events of a user are handled by the same process.
+    """
+    app: Flask
+    flush_interval: float
+    batch_size: int
+    max_entries: int
+    writes: int
+    conflicts: int
+    _entries: OrderedDict[str, _Data]
+    _pending: Dict[str, _Data]
+    _lock: threading.Lock
+    _wake: threading.Event
+    _stopping: bool
+    _thread: Optional[threading.Thread]
+
+    def __init__(
+        self,
+        app: Flask,
+        flush_interval: float,
+        batch_size: int = 100,
+        max_entries: int = 10000,
+    ) -> None:
+        self.app = app
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_entries = max_entries
+        self.writes = self.conflicts = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def get(self, user_id: str) -> Optional[_Data]:
+        """ Return the cached data of the user `user_id` if found. """
+        with self._lock:
+            res = self._entries.get(user_id)
+            if res is not None:
+                self._entries.move_to_end(user_id)
+            return res
+
+    def add(self, data: _Data) -> None:
+        """ Cache the data `data` loaded from the database. """
+        with self._lock:
+            if data.user_id not in self._pending:
+                self._entries[data.user_id] = data
+                self._evict()
+
+    def put(self, before: _Data, after: _Data) -> None:
+        """ Cache the data `after` changed from `before`
+            and write it to the database later.
+        """
+        with self._lock:
+            self._entries[after.user_id] = after
+            self._entries.move_to_end(after.user_id)
+            # Keep the data to check against when writing
+            before = self._pending.setdefault(after.user_id, before)
+            if before == after:  # Changed back; nothing to write
+                del self._pending[after.user_id]
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+            self._evict()
+
+    def flush(self) -> int:
+        """ Write all pending states to the database in a transaction
+            and return the number of written states.
+        """
+        with self._lock:
+            # Pending states are never evicted; skip any missing one defensively
+            afters = {k: self._entries[k] for k in self._pending.keys()
+                      if k in self._entries}
+            pending = {k: v for k, v in self._pending.items() if k in afters}
+            self._pending = {}
+        if not pending:
+            return 0
+        res = 0
+        dropped = set()
+        unspent = set()
+        try:
+            with self.app.app_context():
+                for user_id, before in pending.items():
+                    try:
+                        if _update_user(before, afters[user_id]):
+                            res += 1
+                            continue
+                    except InsufficientWealthError as e:
+                        # Keep the rest of the state and reload the wealth next time
+                        _LOGGER.warning(f"Writing the cached state without spending: {e}")
+                        _insufficient_wealth.inc()
+                        unspent.add(user_id)
+                        after = afters[user_id]._replace(wealth=before.wealth)
+                        if after == before:
+                            continue
+                        if _update_user(before, after):
+                            res += 1
+                            continue
+                    # Written by others; drop it and reload it next time
+                    _LOGGER.warning(
+                        f"Dropped the cached state of user {user_id}"
+                        " modified concurrently")
+                    self.conflicts += 1
+                    dropped.add(user_id)
+                    with self._lock:
+                        self._entries.pop(user_id, None)
+                db.session.commit()
+        except Exception:
+            # Nothing is written; retry later except the dropped states
+            with self._lock:
+                # Check against the states still in the database
+                self._pending.update(
+                    (k, v) for k, v in pending.items() if k not in dropped)
             raise
+        with self._lock:
+            for user_id in unspent:
+                if user_id not in self._pending:
+                    self._entries.pop(user_id, None)
+        self.writes += res
+        return res
+
+    def start(self) -> None:
+        """ Start writing pending states in the background. """
+        self._thread = threading.Thread(
+            target=self._run, name="StateCache", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """ Stop the background writing and write all pending states. """
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        """ Return the size and the counters of the cache. """
+        return {
+            "size": len(self._entries),
+            "pending": len(self._pending),
+            "writes": self.writes,
+            "conflicts": self.conflicts,
+        }
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                _LOGGER.exception("Failed to write cached states", exc_info=e)
+
+    def _evict(self) -> None:
+        """ Evict the least recently used states which are not pending. """
+        excess = len(self._entries) - self.max_entries
+        if excess <= 0:
+            return
+        for user_id in [k for k in self._entries.keys()
+                        if k not in self._pending][:excess]:
+            del self._entries[user_id]
+
+
+state_cache: Optional[StateCache] = None
+""" The write-behind cache of user states if enabled. """
+
+
+metrics.stats_metrics(
+    "duzhibot_state_cache", "The size of the user state cache",
+    lambda: {(k,): v for k, v in state_cache.stats().items()}
+    if state_cache is not None else {}, {
+        "writes": "User states written by the state cache",
+        "conflicts": "Cached user states dropped for conflicts",
+    })
+
+
+def init_state_cache(app: Flask, flush_interval: float, batch_size: int) -> None:
+    """ Enable the write-behind cache of user states for `app`. """
+    global state_cache
+    state_cache = StateCache(app, flush_interval, batch_size)
+    state_cache.start()
+
+
+def _insert_user(user_id: str) -> _User:
+    """ Insert a new user `user_id` if not existing and return the user.
+        Use a single `INSERT ... ON CONFLICT DO NOTHING RETURNING` if supported.
+    """
+    values = {"user_id": user_id, "state": world_initial, "attrs": None,
+              "nick": None, "wealth": world_rules.initial_wealth}
+    dialect = db.get_engine().dialect
+    row: Optional[Dict[str, Any]] = None
+    if dialect.name in ("postgresql", "sqlite"):
+        dialect_insert = {
+            "postgresql": postgresql.insert, "sqlite": sqlite.insert,
+        }[dialect.name]
+        stmt = (dialect_insert(_User).values(**values)
+                .on_conflict_do_nothing(index_elements=["user_id"]))
+        if getattr(dialect, "full_returning", False):
+            ret = db.session.execute(
+                stmt.returning(*_User.__table__.c)).one_or_none()
+            row = ({c.key: ret._mapping[c] for c in _User.__table__.c}
+                   if ret is not None else None)
+        else:
+            res = db.session.execute(stmt)
+            if res.rowcount == 1:
+                row = {"id": res.inserted_primary_key[0], **values}
+    else:
+        try:
+            with db.session.begin_nested():
+                res = db.session.execute(insert(_User).values(**values))
+            row = {"id": res.inserted_primary_key[0], **values}
+        except IntegrityError:
+            pass
+
+    if row is None:  # Added by others concurrently
+        return db.session.query(_User).filter_by(user_id=user_id).one()
+    model = _User(**row)
+    make_transient_to_detached(model)
+    db.session.add(model)
+    return model
@@ -0,0 +1,100 @@
+""" diagram
+    Drawing the FSM diagrams with a content-addressed cache,
+    so that only the diagrams of the changed machines are redrawn.
+
+    Usage: python -m duzhibot.diagram [--force] [diagram...]
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import sys
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+import fsm
+import parse
+from fsm_utils import Machine
+
+_LOGGER = logging.getLogger(__name__)
+
+Diagram = NamedTuple(
+    "Diagram", path=str, build=Callable[[], Machine],
+)
+
+diagrams: Dict[str, Diagram] = {
+    "main": Diagram("img/show-fsm.png", fsm.build_world_graph_machine),
+    "lexer": Diagram("img/show-fsm-lexer.png", parse.build_lex_graph_machine),
+    "parser": Diagram("img/show-fsm-parser.png", parse.build_parse_graph_machine),
+}
+""" The diagrams to draw for serving. """
+
+cache_dir = os.getenv("DIAGRAM_CACHE", ".diagram-cache")
+""" The directory for the drawn diagrams named by their keys. """
+
+_prog = "dot"
+_format = "png"
+
+
+def _source(graph: Any) -> str:
+    """ Return the DOT source of `graph` from either Graphviz binding. """
+    res = getattr(graph, "source", None)
+    return res if isinstance(res, str) else graph.string()
+
+
+def diagram_key(graph: Any) -> str:
+    """ Return the key of the diagram of `graph`,
+        which changes whenever the drawing would change.
+    """
+    h = hashlib.sha256(f"{_prog}\0{_format}\0".encode())
+    h.update(_source(graph).encode())
+    return h.hexdigest()
+
+
+def _same_file(a: str, b: str) -> bool:
+    if not os.path.exists(b) or os.path.getsize(a) != os.path.getsize(b):
+        return False
+    with open(a, "rb") as fa, open(b, "rb") as fb:
+        return fa.read() == fb.read()
+
+
+def draw(diagram: Diagram, force: bool = False) -> bool:
+    """ Draw `diagram` from the cache if possible, or into the cache otherwise.
+        Return whether the diagram is drawn by Graphviz.
+    """
+    graph = diagram.build().get_graph()
+    key = diagram_key(graph)
+    cached = os.path.join(cache_dir, f"{key}.{_format}")
+    drawn = force or not os.path.exists(cached)
+    if drawn:
+        os.makedirs(cache_dir, exist_ok=True)
+        # keep the extension, which some bindings replace with the format
+        tmp = os.path.join(cache_dir, f".{key}.{os.getpid()}.{_format}")
+        graph.draw(tmp, prog=_prog, format=_format)
+        os.replace(tmp, cached)
+    if not _same_file(cached, diagram.path):
+        os.makedirs(os.path.dirname(diagram.path), exist_ok=True)
+        shutil.copy2(cached, diagram.path)
+    return drawn
+
+
+def draw_all(names: Optional[Iterable[str]] = None, force: bool = False) -> Dict[str, bool]:
+    """ Draw the diagrams named `names` (default: all of `diagrams`).
+        Return whether each diagram is drawn by Graphviz.
+    """
+    res = {}
+    for name in names if names is not None else diagrams.keys():
+        res[name] = draw(diagrams[name], force)
+        _LOGGER.info(f"Diagram {name}: {'drawn' if res[name] else 'cached'}")
+    return res
+
+
+def main(argv: List[str]) -> None:
+    force = "--force" in argv
+    names = [v for v in argv if v != "--force"] or None
+    for name, drawn in draw_all(names, force).items():
+        print(f"{diagrams[name].path}: {'drawn' if drawn else 'cached'}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,127 @@
+""" evqueue
+    A durable queue of webhook events backed by a local SQLite database.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    destination TEXT,
+    event TEXT NOT NULL,
+    enqueued_at REAL NOT NULL,
+    claimed_by TEXT,
+    claimed_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS events_claimed_by ON events (claimed_by, user_id);
+"""
+
+
+class QueuedEvent(NamedTuple):
+    id: int
+    user_id: str
+    destination: Optional[str]
+    event: Dict[str, Any]
+    attempts: int
+
+
+def event_user_id(event: Dict[str, Any]) -> str:
+    """ Return the ID of the user, group, or room which sends the raw `event`. """
+    source = event.get("source") or {}
+    return source.get("userId") or source.get("groupId") or source.get("roomId") or ""
+
+
+class EventQueue:
+    """ A queue of raw webhook events stored in the SQLite database at `path`.
+        Events are claimed by workers and deleted once acknowledged,
+        or released to be claimed again if failed.
+        While a worker holds events of a user, other workers are not given
+        any events of that user, so the events of each user are handled in order.
+    """
+    path: str
+    _local: threading.local
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        """ Return the connection of the current thread. """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = FULL")
+            self._local.conn = conn
+        return conn
+
+    def put(self, events: Iterable[Dict[str, Any]], destination: Optional[str] = None) -> int:
+        """ Append the raw `events` in one transaction and return the number of them. """
+        now = time.time()
+        rows = [(event_user_id(ev), destination, json.dumps(ev), now) for ev in events]
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO events (user_id, destination, event, enqueued_at)"
+                " VALUES (?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def claim(self, worker: str, limit: int = 100) -> List[QueuedEvent]:
+        """ Claim at most `limit` of the oldest events for `worker`,
+            skipping the users whose events are held by any worker.
+        """
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, user_id, destination, event, attempts FROM events"
+                " WHERE claimed_by IS NULL AND user_id NOT IN"
+                " (SELECT user_id FROM events WHERE claimed_by IS NOT NULL)"
+                " ORDER BY id LIMIT ?", (limit,)).fetchall()
+            conn.executemany(
+                "UPDATE events SET claimed_by = ?, claimed_at = ? WHERE id = ?",
+                [(worker, time.time(), row[0]) for row in rows])
+        return [QueuedEvent(id, user_id, dst, json.loads(ev), attempts)
+                for id, user_id, dst, ev, attempts in rows]
+
+    def ack(self, ids: Iterable[int]) -> None:
+        """ Delete the handled events with `ids`. """
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("DELETE FROM events WHERE id = ?", [(id,) for id in ids])
+
+    def release(self, ids: Iterable[int]) -> None:
+        """ Release the failed events with `ids` to be claimed again,
+            counting the failed attempts.
+        """
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "UPDATE events SET claimed_by = NULL, claimed_at = NULL,"
+                " attempts = attempts + 1 WHERE id = ?", [(id,) for id in ids])
+
+    def release_stale(self, timeout: float) -> int:
+        """ Release the events claimed more than `timeout` seconds ago,
+            e.g., by crashed workers, and return the number of them.
+            The release counts as a failed attempt.
+        """
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            return conn.execute(
+                "UPDATE events SET claimed_by = NULL, claimed_at = NULL,"
+                " attempts = attempts + 1"
+                " WHERE claimed_at < ?", (time.time() - timeout,)).rowcount
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM events").fetchone()[0]
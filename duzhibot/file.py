@@ -2,10 +2,20 @@
     Utility functions for handling file contents.
 """
 
+import atexit
 import errno
+import hashlib
+import logging
 import os
 import tempfile
-from typing import Iterator
+import threading
+import time
+from typing import Any, Dict, Iterator, NamedTuple, Optional, OrderedDict
+
+_LOGGER = logging.getLogger(__name__)
+
+default_buffer_size = 64 * 1024
+""" The number of bytes to gather from the chunks before each write. """
 
 
 def mkdir(dir: str) -> None:
@@ -17,13 +27,214 @@ def mkdir(dir: str) -> None:
             raise
 
 
-def save_tmp_file(dir: str, ext: str, chunk_iter: Iterator[bytes]) -> str:
-    """ Save a file to `dir` with extension `ext` and return its path. """
-    with tempfile.NamedTemporaryFile(dir=dir, prefix=f"{ext}-", delete=False) as f:
-        for chunk in chunk_iter:
-            f.write(chunk)
+def _write_chunks(f: Any, chunk_iter: Iterator[bytes], buffer_size: int,
+                  h: Optional[Any] = None) -> int:
+    """ Write `chunk_iter` to the binary file `f` in blocks of `buffer_size` bytes,
+        updating the hash object `h` if given. Return the number of written bytes.
+    """
+    buf = bytearray()
+    res = 0
+    for chunk in chunk_iter:
+        buf += chunk
+        if len(buf) >= buffer_size:
+            f.write(buf)
+            if h is not None:
+                h.update(buf)
+            res += len(buf)
+            buf.clear()
+    if buf:
+        f.write(buf)
+        if h is not None:
+            h.update(buf)
+        res += len(buf)
+    return res
+
+
+def save_tmp_file(dir: str, ext: str, chunk_iter: Iterator[bytes],
+                  buffer_size: int = default_buffer_size) -> str:
+    """ Save a file to `dir` with extension `ext` and return its path.
+        The file is saved with `TmpStore.save()` if `dir` is of a `TmpStore`.
+    """
+    store = _stores.get(os.path.realpath(dir))
+    if store is not None:
+        return store.save(ext, chunk_iter)
+    with tempfile.NamedTemporaryFile(
+            dir=dir, prefix=f"{ext}-", delete=False, buffering=0) as f:
+        _write_chunks(f, chunk_iter, buffer_size)
         raw_path = f.name
 
     res = f"{raw_path}.{ext}"
     os.rename(raw_path, res)  # Ready to serve
     return res
+
+
+_TmpEntry = NamedTuple("_TmpEntry", size=int, saved_at=float)
+
+_stores: Dict[str, "TmpStore"] = {}
+""" The `TmpStore` of each real path of directories. """
+
+
+class TmpStore:
+    """ Temporary files in the directory `dir` named by their content hashes,
+        so that identical contents are stored once.
+        Files older than `ttl` seconds are removed, and the least recently used
+        files are removed while the total size exceeds `budget` bytes,
+        by a background thread every `interval` seconds or once over budget.
+    """
+    dir: str
+    budget: int
+    ttl: float
+    interval: float
+    buffer_size: int
+    saves: int
+    dedups: int
+    evictions: int
+    expirations: int
+    _entries: OrderedDict[str, _TmpEntry]
+    _size: int
+    _lock: threading.Lock
+    _wake: threading.Event
+    _stopping: bool
+    _thread: Optional[threading.Thread]
+
+    def __init__(
+        self,
+        dir: str,
+        budget: int,
+        ttl: float,
+        interval: float = 60,
+        buffer_size: int = default_buffer_size,
+    ) -> None:
+        self.dir = dir
+        self.budget = budget
+        self.ttl = ttl
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.saves = self.dedups = self.evictions = self.expirations = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        _stores[os.path.realpath(dir)] = self
+
+    def scan(self) -> None:
+        """ Track the files already in `dir`, the least recently modified first. """
+        mkdir(self.dir)
+        found = []
+        with os.scandir(self.dir) as it:
+            for e in it:
+                if e.is_file() and not e.name.startswith("."):
+                    st = e.stat()
+                    found.append((st.st_mtime, e.name, st.st_size))
+        with self._lock:
+            for mtime, name, size in sorted(found):
+                self._track(name, _TmpEntry(size, mtime))
+
+    def save(self, ext: str, chunk_iter: Iterator[bytes]) -> str:
+        """ Save a file with extension `ext` and return its path,
+            which is the path of the existing file with the same content if any.
+        """
+        h = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(
+                dir=self.dir, prefix=".", delete=False, buffering=0) as f:
+            size = _write_chunks(f, chunk_iter, self.buffer_size, h)
+            raw_path = f.name
+
+        name = f"{h.hexdigest()[:32]}.{ext}"
+        res = os.path.join(self.dir, name)
+        # Renamed and removed with the lock held for not racing with `evict()`
+        with self._lock:
+            self.saves += 1
+            if name in self._entries and os.path.exists(res):
+                self.dedups += 1
+                os.unlink(raw_path)
+                os.utime(res)  # Keep it from expiring
+            else:
+                os.replace(raw_path, res)  # Ready to serve
+            self._track(name, _TmpEntry(size, time.time()))
+            over = self._size > self.budget
+        if over:
+            self._wake.set()
+        return res
+
+    def touch(self, name: str) -> None:
+        """ Mark the file `name` in `dir` as recently used. """
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+
+    def evict(self) -> int:
+        """ Remove the expired files and then the least recently used files
+            over the budget. Return the number of removed files.
+        """
+        now = time.time()
+        removed = []
+        with self._lock:
+            for name, entry in list(self._entries.items()):
+                if now - entry.saved_at > self.ttl:
+                    removed.append(name)
+                    self._untrack(name)
+                    self.expirations += 1
+            while self._size > self.budget and self._entries:
+                name = next(iter(self._entries))
+                removed.append(name)
+                self._untrack(name)
+                self.evictions += 1
+            for name in removed:
+                try:
+                    os.unlink(os.path.join(self.dir, name))
+                except FileNotFoundError:
+                    pass
+        return len(removed)
+
+    def start(self) -> None:
+        """ Start removing files in the background if not started yet. """
+        if self._thread is not None:
+            return
+        self.scan()
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name="TmpStore", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """ Stop removing files in the background. """
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> Dict[str, int]:
+        """ Return the usage and the counters of the store. """
+        return {
+            "files": len(self._entries),
+            "bytes": self._size,
+            "budget": self.budget,
+            "saves": self.saves,
+            "dedups": self.dedups,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _track(self, name: str, entry: _TmpEntry) -> None:
+        self._untrack(name)
+        self._entries[name] = entry
+        self._size += entry.size
+
+    def _untrack(self, name: str) -> None:
+        old = self._entries.pop(name, None)
+        if old is not None:
+            self._size -= old.size
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.evict()
+            except Exception as e:
+                _LOGGER.exception("Failed to remove temporary files", exc_info=e)
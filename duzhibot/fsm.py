@@ -1,13 +1,22 @@
 import logging
+import os
+import pickle
 from functools import partial
-from typing import Any, Callable, List, Optional, Union
+from importlib.util import find_spec
+from types import MappingProxyType
+from typing import (Any, Callable, Dict, FrozenSet, List, Mapping,
+                    NamedTuple, Optional, Tuple, Union, cast)
 
 import linebot.models as lm
 from flask import request, g as fg
 
+import assets
 import parse
-import world
-from fsm_utils import EventData, HierarchicalGraphMachine, MachineCtxMngable
+import metrics
+import world_rules
+from fsm_utils import (Config_t, EventData, HierarchicalMachine, Machine,
+                       MachineCtxMngable, ModelPool, build_graph_machine,
+                       config_digest, get_state_names, runtime_configs)
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -26,16 +35,170 @@ def on_exit(state: str, ev: EventData) -> None:
     _LOGGER.info(f"Leaving {state}")
 
 
-_configs = {
-    "title": "Main Machine",
-    **world.world,
-    "auto_transitions": False,
-    "show_conditions": True,
-    "send_event": True,
-}
-world_initial = _configs["initial"]
-world_state_invalid = world.state_invalid
-world_machine = HierarchicalGraphMachine(model=None, **_configs)
+def world_configs() -> Config_t:
+    """ Return the configs of the world machine generated by `world`. """
+    import world
+    return {
+        "title": "Main Machine",
+        **world.world,
+        "auto_transitions": False,
+        "show_conditions": True,
+        "send_event": True,
+    }
+
+
+world_state_invalid = world_rules.state_invalid
+
+
+StateTriggers = NamedTuple(
+    "StateTriggers", triggers=FrozenSet[str], lambda_only=bool,
+)
+
+
+def _index_triggers(machine: HierarchicalMachine) -> Dict[str, StateTriggers]:
+    """ Return a map from every state name of `machine`
+        to (its available triggers, whether only λ-transitions are available).
+    """
+    res = {}
+    for name in machine.get_nested_state_names():
+        triggers = machine.get_triggers(name)
+        res[name] = StateTriggers(
+            frozenset(triggers),
+            all(t == world_rules.trig_lambda for t in triggers))
+    return res
+
+
+WorldSnapshot = NamedTuple(
+    "WorldSnapshot", digest=str, initial=str, state_names=List[str],
+    triggers=Dict[str, StateTriggers], machine=bytes,
+)
+
+world_snapshot_path = os.getenv("WORLD_SNAPSHOT")
+""" The path of the snapshot of the world machine if enabled. """
+
+
+def world_digest() -> str:
+    """ Return the digest of the sources which define the world machine,
+        without importing `world`.
+    """
+    paths = [cast(str, find_spec(m).origin)  # type: ignore[union-attr]
+             for m in ["world", "world_rules", "fsm_utils"]]
+    return config_digest([*paths, __file__])
+
+
+def build_world_snapshot(configs: Optional[Config_t] = None) -> WorldSnapshot:
+    """ Return a snapshot of the world machine built from `configs`
+        (default: `world_configs()`).
+    """
+    configs = configs if configs is not None else world_configs()
+    machine = HierarchicalMachine(model=None, **runtime_configs(configs))
+    return WorldSnapshot(
+        world_digest(), configs["initial"], get_state_names(configs),
+        _index_triggers(machine), pickle.dumps(machine, pickle.HIGHEST_PROTOCOL))
+
+
+def load_world_snapshot(path: str) -> Optional[WorldSnapshot]:
+    """ Return the snapshot at `path` if it is up to date. """
+    try:
+        with open(path, "rb") as f:
+            res = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        _LOGGER.warning(f"Ignored unreadable snapshot {path}: {e!r}")
+        return None
+    if not isinstance(res, WorldSnapshot) or res.digest != world_digest():
+        _LOGGER.info(f"Ignored outdated snapshot {path}")
+        return None
+    return res
+
+
+def save_world_snapshot(path: str, snapshot: WorldSnapshot) -> None:
+    """ Write `snapshot` to `path` atomically. """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def _init_world_snapshot() -> Optional[WorldSnapshot]:
+    """ Return the snapshot at `world_snapshot_path`
+        and rebuild it first if it is outdated.
+    """
+    if world_snapshot_path is None:
+        return None
+    res = load_world_snapshot(world_snapshot_path)
+    if res is None:
+        res = build_world_snapshot()
+        try:
+            save_world_snapshot(world_snapshot_path, res)
+        except OSError as e:
+            _LOGGER.warning(f"Failed to save snapshot {world_snapshot_path}: {e!r}")
+    return res
+
+
+world_snapshot = _init_world_snapshot()
+if world_snapshot is not None:
+    # load everything from the snapshot without generating the configs in `world`
+    world_initial = world_snapshot.initial
+    world_state_names = world_snapshot.state_names
+else:
+    _configs = world_configs()
+    world_initial = _configs["initial"]
+    world_state_names = get_state_names(_configs)
+
+
+def build_world_machine() -> HierarchicalMachine:
+    """ Return a new machine for the world. """
+    if world_snapshot is not None:
+        return pickle.loads(world_snapshot.machine)
+    return HierarchicalMachine(model=None, **runtime_configs(_configs))
+
+
+def build_world_graph_machine() -> Machine:
+    """ Return a new machine for the world with graph support for drawing. """
+    return build_graph_machine(world_configs())
+
+
+world_machine = build_world_machine()
+
+world_triggers: Mapping[str, StateTriggers] = MappingProxyType(
+    world_snapshot.triggers if world_snapshot is not None
+    else _index_triggers(world_machine))
+""" The available triggers for each state of `world_machine`. """
+
+_commands = metrics.Counter(
+    "duzhibot_commands_total", "Parsed commands by whether they triggered a transition",
+    ["cmd", "result"])
+_transitions = metrics.Counter(
+    "duzhibot_transitions_total", "Transitions of the world machine by states",
+    ["source", "dest"])
+
+help_text = "/help"
+quick_reply_texts = [help_text]
+""" The texts of all quick reply buttons which the bot can send. """
+
+
+class Profile:
+    """ The profile of a user loaded along with the state,
+        whose changes are saved along with the state.
+    """
+    nick: Optional[str]
+    wealth: int
+
+    def __init__(self, nick: Optional[str] = None,
+                 wealth: int = world_rules.initial_wealth) -> None:
+        self.nick = nick
+        self.wealth = wealth
+
+    def spend(self, amount: int) -> bool:
+        """ Deduct `amount` from the wealth if enough.
+            Return whether it is deducted.
+        """
+        if self.wealth < amount:
+            return False
+        self.wealth -= amount
+        return True
 
 
 class WorldModel(MachineCtxMngable):
@@ -45,45 +208,112 @@ class WorldModel(MachineCtxMngable):
     state: Union[partial, Any]
     trigger: Union[partial, Any]
 
+    profile: Profile
+    chair_expected: str
+    mt19937_dst: Tuple[int, int]
+
+    attr_types: Mapping[str, Callable[[Any], Any]] = MappingProxyType({
+        "chair_expected": str,
+        "mt19937_dst": lambda v: (int(v[0]), int(v[1])),
+    })
+    """ The runtime attributes kept for each user
+        with the conversions from their JSON values.
+    """
+
     def __init__(self, initial: Optional[str] = None) -> None:
         if initial is not None:  # Ensure `initial` is valid
-            try:
-                world_machine.get_state(initial)
-            except ValueError:
-                initial = world_state_invalid
+            initial = self.valid_state(initial)
         self._initial = initial
 
+    @staticmethod
+    def valid_state(state: str) -> str:
+        """ Return `state` if it is a state of `world_machine`
+            or `world_state_invalid` otherwise.
+        """
+        return state if state in world_triggers else world_state_invalid
+
+    def _reset(self) -> None:
+        self.profile = Profile()
+        for k in self.attr_types:
+            self.__dict__.pop(k, None)
+
+    def load_attrs(self, attrs: Optional[Mapping[str, Any]]) -> None:
+        """ Set the runtime attributes from their JSON values `attrs`,
+            skipping the unknown and the malformed ones.
+        """
+        for k, v in (attrs or {}).items():
+            conv = self.attr_types.get(k)
+            if conv is None:
+                continue
+            try:
+                setattr(self, k, conv(v))
+            except (TypeError, ValueError, IndexError):
+                _LOGGER.warning(f"Skipped malformed attribute {k}={v!r}")
+
+    def dump_attrs(self) -> Optional[Dict[str, Any]]:
+        """ Return the JSON values of the set runtime attributes,
+            or `None` if none is set.
+        """
+        res = {k: list(v) if isinstance(v, tuple) else v
+               for k, v in self.__dict__.items() if k in self.attr_types}
+        return res or None
+
     def exec(self, event: lm.Event, reply: Reply_t) -> bool:
         """ Parse `event` and try to trigger `self` with the parsing result.
             Return whether the parsed command is valid and available.
         """
-        triggers = world_machine.get_triggers(self.state)
         cmd, args, kwargs = parse.parse(event.message.text)
-        res = (
-            cmd in triggers
-            and self.trigger(cmd, *args, **kwargs, event=event, reply=reply))
-
-        # Allow only lambda transitions which appear alone for deterministic
-        resk = res
-        while resk:
-            triggers = world_machine.get_triggers(self.state)
-            if triggers.count(world.trig_lambda) != len(triggers):
-                break
-            resk = self.trigger(
-                world.trig_lambda, event=event, reply=reply)
+        res = self.exec_cmd(cmd, args, kwargs, event, reply)
 
         # Fallback message
         if not res:
-            _LOGGER.info(f"{fg.rqst_root_url}/img/huisha-v2.png")
+            img_url = assets.static_assets.url("img/huisha-v2.png")
+            _LOGGER.debug("%s/%s", fg.rqst_root_url, img_url)
             reply([
                 lm.ImageSendMessage(
-                    original_content_url=f"{request.root_url}/img/huisha-v2.png",
+                    original_content_url=f"{request.root_url}/{img_url}",
                 ),
                 lm.TextSendMessage(
                     text="無此命令……請用 `/help` 査看可用命令。",
                     quick_reply=lm.QuickReply([lm.QuickReplyButton(
-                        action=lm.MessageAction(label="/help", text="/help"))],
+                        action=lm.MessageAction(
+                            label=help_text, text=help_text))],
                     )),
             ])
 
         return res
+
+    def exec_cmd(
+        self, cmd: Optional[str], args: Tuple, kwargs: Mapping[str, Any],
+        event: Optional[lm.Event], reply: Reply_t,
+    ) -> bool:
+        """ Try to trigger `self` with the command `cmd` and its arguments
+            and follow the λ-transitions after it.
+            Return whether the command is available and triggered.
+        """
+        with metrics.stage("exec"):
+            src = self.state
+            res = (
+                cmd in world_triggers[self.state].triggers
+                and self.trigger(cmd, *args, **kwargs, event=event, reply=reply))
+            _commands.inc(str(cmd), "accepted" if res else "rejected")
+            if res:
+                _transitions.inc(src, self.state)
+
+            # Allow only lambda transitions which appear alone for deterministic
+            resk = res
+            while resk:
+                if not world_triggers[self.state].lambda_only:
+                    break
+                src = self.state
+                with metrics.stage("lambda"):
+                    resk = self.trigger(
+                        world_rules.trig_lambda, event=event, reply=reply)
+                if resk:
+                    _transitions.inc(src, self.state)
+        return res
+
+
+world_models = ModelPool(world_machine, WorldModel, build_world_machine)
+""" The reusable models attached to `world_machine` or its per-thread copies.
+"""
@@ -10,35 +10,75 @@
     Utilities for defining FSMs.
 """
 
-from contextlib import AbstractContextManager
+import hashlib
+import threading
+from contextlib import AbstractContextManager, contextmanager
+from functools import lru_cache
 from types import TracebackType
-from typing import (Callable, Collection, Dict, List, Literal, Optional,
-                    Protocol, Sequence, Type, Union, cast)
+from typing import (Any, Callable, Collection, Dict, Generic, Iterable,
+                    Iterator, List, Literal, Optional, Protocol, Sequence,
+                    Tuple, Type, TypeVar, Union, cast)
 
+import transitions
 from transitions import EventData, Machine
-from transitions.extensions import GraphMachine, HierarchicalGraphMachine
+from transitions.extensions import HierarchicalMachine
 from transitions.extensions.nesting import NestedState
 from transitions.extensions.states import Tags, add_state_features
 
 _sep = NestedState.separator = '__'
 
-# customize the graphic styling
-for attrs in ["hierarchical_machine_attributes", "machine_attributes"]:
-    config = getattr(GraphMachine, attrs)
-    config.update(
-        rankdir="LR",  # arranging left-to-right
-        nodesep="0.32",  # default: 0.25
-        pad="0.222,0.111",  # default: 0.0555
-    )
-
-# make the "white" objects in the generated graph semi-transparent
-style_attrs = cast(Dict[str, Dict[str, Dict[str, str]]],
-                   GraphMachine.style_attributes)
-for states in style_attrs.values():
-    for attrs in states.values():
-        for k, v in attrs.items():
-            if k == "fillcolor" and v == "white":
-                attrs[k] = "#ffffff3f"
+
+# Graph
+
+_graph_kwargs = frozenset([
+    "title", "show_conditions", "show_state_attributes",
+    "show_auto_transitions", "use_pygraphviz", "graph_engine",
+])
+""" The keyword arguments only for machines with graph support. """
+
+
+def runtime_configs(configs: Dict[str, Any]) -> Dict[str, Any]:
+    """ Return `configs` without the options only for drawing graphs,
+        for building machines without graph support.
+    """
+    return {k: v for k, v in configs.items() if k not in _graph_kwargs}
+
+
+@lru_cache(maxsize=None)
+def _style_graphs() -> None:
+    """ Customize the graphic styling once graphs are needed. """
+    from transitions.extensions import GraphMachine
+    for attrs in ["hierarchical_machine_attributes", "machine_attributes"]:
+        config = getattr(GraphMachine, attrs)
+        config.update(
+            rankdir="LR",  # arranging left-to-right
+            nodesep="0.32",  # default: 0.25
+            pad="0.222,0.111",  # default: 0.0555
+        )
+
+    # make the "white" objects in the generated graph semi-transparent
+    style_attrs = cast(Dict[str, Dict[str, Dict[str, str]]],
+                       GraphMachine.style_attributes)
+    for states in style_attrs.values():
+        for attrs in states.values():
+            for k, v in attrs.items():
+                if k == "fillcolor" and v == "white":
+                    attrs[k] = "#ffffff3f"
+
+
+def build_graph_machine(configs: Dict[str, Any], *state_features: type) -> Machine:
+    """ Return a new machine with graph support built from `configs`
+        with the states having `state_features`.
+        The machine is its own model unless `configs` specifies otherwise.
+    """
+    from transitions.extensions import HierarchicalGraphMachine
+    _style_graphs()
+    cls: Type[Machine] = HierarchicalGraphMachine
+    if state_features:
+        cls = add_state_features(*state_features)(
+            type(cls.__name__, (cls,), {}))
+    return cls(**configs)
+
 
 # Types
 
@@ -57,32 +97,34 @@ Config_t = Dict[str, Union[List["State_t"], TransList_t, List[str], str]]
 
 Visit_t = Callable[[Optional[str], Optional[Config_t], int], None]
 
+# Subscripted once here, as subscripting per call is costly
+_StateList_t = List[State_t]
+_TransSpecList_t = List[Trans_t]
+
 
 # Context manager
 
 class MachineCtxMngable(Protocol):
     _initial: Optional[str] = None
 
+    def _reset(self) -> None:
+        """ Reset the runtime attributes before being reused. """
 
-def MachineCtxMnger(
-    machine: Machine,
-    model: Optional[MachineCtxMngable] = None,
-) -> Type[AbstractContextManager]:
+
+@lru_cache(maxsize=None)
+def MachineCtxMnger(machine: Machine) -> Type[AbstractContextManager]:
     """ Return a class whose instances, when used with `with` statement,
         automatically attach to and detach from the given `Machine` `machine`
         as a model
         and become available as the `as` object.
-        The returned class to be used as a mixin.
-        If `model` is given, attach and detach `model` instead of the instance.
+        The returned class to be used as a mixin and is cached per `machine`.
+        If `_ctx_model` of the instance is set, attach and detach it instead.
     """
     class Res(AbstractContextManager, MachineCtxMngable):
-        if model is not None:
-            def __get_model(self: "Res") -> MachineCtxMngable:
-                assert model is not None
-                return model
-        else:
-            def __get_model(self: "Res") -> MachineCtxMngable:
-                return self
+        _ctx_model: Optional[MachineCtxMngable] = None
+
+        def __get_model(self) -> MachineCtxMngable:
+            return self._ctx_model if self._ctx_model is not None else self
 
         def __enter__(self) -> MachineCtxMngable:
             machine.add_model(self.__get_model(), self.__get_model()._initial)
@@ -107,7 +149,107 @@ def machine_ctx_mnger(
         automatically attach to and detach from the given `Machine` `machine`
         as a model.
     """
-    return MachineCtxMnger(machine, model)()
+    res = MachineCtxMnger(machine)()
+    res._ctx_model = model
+    return res
+
+
+Model_t = TypeVar("Model_t", bound=MachineCtxMngable)
+
+
+class ModelPool(Generic[Model_t]):
+    """ A pool of models which stay attached to a machine
+        and are reused instead of being attached and detached per use.
+        New models are created with `factory()` only when the pool runs out.
+
+        Each thread has its own machine and its own models,
+        so that no machine is shared between threads.
+        The thread creating the pool uses the `Machine` `machine`;
+        the other threads use the machines lazily built with `build()`.
+    """
+    factory: Callable[[], Model_t]
+    build: Callable[[], Machine]
+    size: int
+    _initial: Optional[str]
+    _local: threading.local
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        machine: Machine,
+        factory: Callable[[], Model_t],
+        build: Callable[[], Machine],
+    ) -> None:
+        self.factory = factory
+        self.build = build
+        self.size = 0
+        self._initial = None
+        self._local = threading.local()
+        self._local.machine = machine
+        self._lock = threading.Lock()
+
+    @property
+    def machine(self) -> Machine:
+        """ The machine of the current thread. """
+        res = getattr(self._local, "machine", None)
+        if res is None:
+            res = self._local.machine = self.build()
+        return res
+
+    def _free(self) -> List[Model_t]:
+        res = getattr(self._local, "free", None)
+        if res is None:
+            res = self._local.free = []
+        return res
+
+    def checkout(self, initial: Optional[str] = None) -> Model_t:
+        """ Return a model in the state `initial` if given
+            or in the initial state of the machine otherwise.
+            The model should be returned with `checkin()` in the same thread.
+        """
+        machine = self.machine
+        free = self._free()
+        if free:
+            model = free.pop()
+        else:
+            model = self.factory()
+            machine.add_model(model)
+            with self._lock:
+                if self._initial is None:
+                    self._initial = getattr(model, machine.model_attribute)
+                self.size += 1
+        model._reset()
+        machine.set_state(
+            initial if initial is not None else self._initial, model)
+        return model
+
+    def checkin(self, model: Model_t) -> None:
+        """ Return the model `model` from `checkout()` to the pool. """
+        self._free().append(model)
+
+    @contextmanager
+    def __call__(self, initial: Optional[str] = None) -> Iterator[Model_t]:
+        """ Return a context manager which checks out a model in `initial`
+            as the `as` object and checks it in afterwards.
+        """
+        model = self.checkout(initial)
+        try:
+            yield model
+        finally:
+            self.checkin(model)
+
+
+# Snapshot
+
+def config_digest(paths: Iterable[str]) -> str:
+    """ Return a hex digest of the files at `paths` and the version of `transitions`
+        for telling whether anything derived from them is outdated.
+    """
+    h = hashlib.sha256(transitions.__version__.encode())
+    for path in paths:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
 
 
 def is_dummy_parent(state: State_t) -> bool:
@@ -133,7 +275,7 @@ def get_children(state: State_t) -> List[State_t]:
     res = state.get("children", state.get("states", []))
     assert (isinstance(res, list)
             and all(not isinstance(v, list) for v in res))
-    return cast(List[State_t], res)
+    return cast(_StateList_t, res)
 
 
 def get_child(state: State_t, name: str) -> Optional[State_t]:
@@ -147,7 +289,7 @@ def get_transitions(config: Config_t) -> List[Trans_t]:
     """ Return the non-nested transitions in `config`. """
     res = config.setdefault("transitions", [])
     assert isinstance(res, list)
-    return cast(List[Trans_t], res)
+    return cast(_TransSpecList_t, res)
 
 
 def visit_states(state: State_t, f: Visit_t, depth: int = 0) -> None:
@@ -169,45 +311,141 @@ def visit_states(state: State_t, f: Visit_t, depth: int = 0) -> None:
         visit_states(s, f, depth + 1)
 
 
-def ignore_transitions(config: Config_t, ign: Sequence[str], dest: Literal["=", None]) -> None:
+class ConfigIndex:
+    """ An index of all (nested) states in `state` built in a single traversal,
+        for the helpers below to look up states without walking `state` again.
+        States are identified by their paths from `state`
+        (their names joined with `_sep`; `""` for `state` itself).
+        The index is not updated when states are added to `state` afterwards.
+    """
+    root: State_t
+    nodes: Dict[str, State_t]
+    parents: Dict[str, Optional[str]]
+    paths: List[str]
+    dummies: List[bool]
+    _children: Dict[str, Dict[str, str]]
+    _spans: Dict[str, Tuple[int, int]]
+    _initials: Dict[str, str]
+
+    def __init__(self, state: State_t) -> None:
+        self.root = state
+        self.nodes = {"": state}
+        self.parents = {"": None}
+        self.paths = []  # in the order of `visit_states()`, without `state` itself
+        self.dummies = []
+        self._children = {}
+        self._spans = {}
+        self._initials = {}
+
+        # (path, state), or (path, None) for the end of the descendants
+        stack: List[Tuple[str, Optional[State_t]]] = [("", state)]
+        while stack:
+            path, node = stack.pop()
+            if node is None:
+                beg, _ = self._spans[path]
+                self._spans[path] = (beg, len(self.paths))
+                continue
+            children = get_children(node)
+            if path:
+                self.paths.append(path)
+                self.dummies.append(bool(children) and is_dummy_parent(node))
+            self._spans[path] = (len(self.paths), len(self.paths))
+            if not children:
+                continue
+            names = self._children.setdefault(path, {})
+            stack.append((path, None))
+            subs = []
+            for child in children:
+                name = get_name(child)
+                assert name is not None
+                sub = f"{path}{_sep}{name}" if path else name
+                names.setdefault(name, sub)
+                self.nodes.setdefault(sub, child)
+                self.parents.setdefault(sub, path)
+                subs.append((sub, child))
+            stack.extend(reversed(subs))
+
+    def child(self, path: str, name: str) -> Optional[str]:
+        """ Return the path of the first non-nested state named `name`
+            in the state at `path` if found.
+        """
+        return self._children.get(path, {}).get(name)
+
+    def children(self, path: str = "") -> Dict[str, str]:
+        """ Return the paths of the non-nested states in the state at `path`
+            by their names.
+        """
+        return self._children.get(path, {})
+
+    def state_names(self, path: str = "", dummy: bool = False) -> List[str]:
+        """ Return the paths of all (nested) states in the state at `path`.
+            Skip dummy parent states unless `dummy` is `True`.
+        """
+        beg, end = self._spans[path]
+        if dummy:
+            return self.paths[beg:end]
+        return [v for v, d in zip(self.paths[beg:end], self.dummies[beg:end]) if not d]
+
+    def initial(self, path: str = "") -> str:
+        """ Return the path of the non-dummy-parent initial state
+            of the state at `path`.
+            All explicitly specified initial state names must be valid.
+        """
+        res = self._initials.get(path)
+        if res is not None:
+            return res
+        node = self.nodes[path]
+        if not is_dummy_parent(node):  # A non-dummy state
+            res = path
+        else:
+            init = cast(Config_t, node)["initial"]
+            assert isinstance(init, str)
+            # Assume that a matching (nested) state will be found
+            sub = self.child(path, init)  # A pseudo-nested state
+            if sub is None:
+                sub = path
+                for p in init.split(_sep):
+                    sub = self.child(sub, p)
+                    assert sub is not None
+            res = self.initial(sub)
+        self._initials[path] = res
+        return res
+
+
+def _prefixed(base: Optional[str], names: List[str]) -> List[str]:
+    if base is None:
+        return names
+    return [f"{base}{_sep}{v}" for v in names]
+
+
+def ignore_transitions(
+    config: Config_t, ign: Sequence[str], dest: Literal["=", None],
+    index: Optional[ConfigIndex] = None,
+) -> None:
     """ Add transitions to `config` for ignoring triggers in `ign_list`.
         `dest` should be either `"="` (reflexive) or `None` (internal).
+        `index` is the `ConfigIndex` of `config` if already built.
     """
-    def f(name: Optional[str], state: Optional[Config_t], depth: int) -> None:
-        if state is None:
-            return
-        get_transitions(state).extend([
-            token,
-            [k for k, v in ((get_name(v), v) for v in get_children(state))
-                if k is not None and not is_dummy_parent(v)],
-            dest,
-        ] for token in ign)
-    visit_states(config, f)
-
-
-def get_state_names(state: State_t, dummy: bool = False, base: str = None) -> List[str]:
+    index = index if index is not None else ConfigIndex(config)
+    for path in (v for v in ["", *index.paths] if index.children(v)):
+        state = cast(Config_t, index.nodes[path])
+        sources = [name for name in (get_name(v) for v in get_children(state))
+                   if name is not None
+                   and not is_dummy_parent(index.nodes[index.children(path)[name]])]
+        get_transitions(state).extend([token, list(sources), dest] for token in ign)
+
+
+def get_state_names(
+    state: State_t, dummy: bool = False, base: str = None,
+    index: Optional[ConfigIndex] = None,
+) -> List[str]:
     """ Return the name of all (nested) states in `state`.
         Skip dummy parent states unless `dummy` is `True`.
         Prepend state names with `base` (with seperator `_sep`) if given.
+        `index` is the `ConfigIndex` of `state` if already built.
     """
-    states: List[str] = []
-    path: List[str] = []
-    plen: List[int] = [0]
-    base = f"{base}{_sep}" if base is not None else ""
-
-    def f(name: Optional[str], state: Optional[Config_t], depth: int) -> None:
-        if depth > 0:
-            assert name is not None
-            if depth > plen[0]:
-                path.append(name)
-                plen[0] += 1
-            else:
-                path[depth - 1] = name
-            if state is None or dummy or not is_dummy_parent(state):
-                states.append(f"{base}{_sep.join(path[:depth])}")
-
-    visit_states(state, f)
-    return states
+    index = index if index is not None else ConfigIndex(state)
+    return _prefixed(base, index.state_names(dummy=dummy))
 
 
 def add_resetters(
@@ -215,26 +453,34 @@ def add_resetters(
     names: Sequence[str],
     dest: str,
     excl: Collection[str] = (),
+    index: Optional[ConfigIndex] = None,
     **kwargs,
 ) -> None:
     """ Add transitions to `config` for resetting.
         States in `excl` will be excluded from the transitions.
+        `index` is the `ConfigIndex` of `config` if already built.
         `**kwargs` will be passed into the transition definitions.
     """
-    states = get_state_names(config)
+    index = index if index is not None else ConfigIndex(config)
+    excl = set(excl)
+    sources = [v for v in index.state_names() if v not in excl]
     get_transitions(config).extend(
         {"trigger": name,
-            "source": [v for v in states if v not in excl],
+            "source": list(sources),
             "dest": dest,
             **kwargs,
          } for name in names)
 
 
-def resolve_initial(state: State_t, base: str = None, depth: int = 0) -> str:
+def resolve_initial(
+    state: State_t, base: str = None, depth: int = 0,
+    index: Optional[ConfigIndex] = None,
+) -> str:
     """ Return the name of the non-dummy-parent initial state of `state`.
         Prepend state names with `base` (with seperator `_sep`) if given.
         `depth` is the distance from the root state.
         All explicitly specified initial state names must be valid.
+        `index` is the `ConfigIndex` of `state` if already built.
     """
     # build the full path to self
     if base is None:
@@ -243,25 +489,22 @@ def resolve_initial(state: State_t, base: str = None, depth: int = 0) -> str:
         prefix = f"{base}{_sep}"
     name = f"{prefix}{get_name(state)}" if depth > 0 else base
 
-    # check self
-    if not is_dummy_parent(state):  # A non-dummy state
-        return name
-    state = cast(Config_t, state)
-    init = state["initial"]
-    assert isinstance(init, str)
-
-    # check children
-    base = name
-    # Assume that a matching (nested) state will be found
-    st = get_child(state, init)
-    if st is not None:  # Found a pseudo-nested state
-        return resolve_initial(st, base, depth + 1)
-
-    # visit descendants
-    st = state
-    path = init.split(_sep)
-    base = _sep.join(v for v in (base, _sep.join(path[:-1])) if v != "")
-    for p in path:
-        st = get_child(st, p)
-        assert st is not None
-    return resolve_initial(st, base, depth + len(path))
+    if index is not None:
+        return _sep.join(v for v in (name, index.initial()) if v != "")
+
+    # Follow the initial states without indexing all states
+    path: List[str] = []
+    while is_dummy_parent(state):
+        state = cast(Config_t, state)
+        init = state["initial"]
+        assert isinstance(init, str)
+        # Assume that a matching (nested) state will be found
+        st = get_child(state, init)
+        if st is None:  # Not a pseudo-nested state
+            st = state
+            for p in init.split(_sep):
+                st = get_child(st, p)
+                assert st is not None
+        path.append(init)
+        state = st
+    return _sep.join(v for v in (name, *path) if v != "")
@@ -0,0 +1,106 @@
+""" logs
+    A non-blocking logging pipeline with lazy formatting,
+    per-category sampling, and truncation and redaction of request bodies.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import random
+import re
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional
+
+sample_rates: Dict[str, float] = {
+    "body": float(os.getenv("LOG_SAMPLE_BODY", 0)),
+    "state": float(os.getenv("LOG_SAMPLE_STATE", 0.01)),
+}
+""" The fraction of the records to log for each category; 1 for all. """
+
+body_max_len = int(os.getenv("LOG_BODY_MAX_LEN", 1024))
+""" The max number of characters of a logged request body. """
+
+redact_keys = [k for k in os.getenv(
+    "LOG_REDACT_KEYS", "replyToken,userId,text").split(",") if k]
+""" The keys in the JSON request bodies whose string values are not logged. """
+
+_sample_rng = random.Random()
+""" The random number generator for sampling,
+    separate from the global one, which the world machine uses.
+"""
+
+
+class _LazyQueueHandler(QueueHandler):
+    """ A `QueueHandler` which leaves formatting to the listener thread.
+        The arguments of the records should not be mutated after logging.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def install(logger: logging.Logger, *handlers: logging.Handler) -> QueueListener:
+    """ Make `logger` pass its records to `handlers` through a queue
+        handled in a background thread, and return the started listener.
+    """
+    q: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    listener = QueueListener(q, *handlers, respect_handler_level=True)
+    logger.addHandler(_LazyQueueHandler(q))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def sampled(category: str) -> bool:
+    """ Return whether to log a record of `category` this time. """
+    rate = sample_rates.get(category, 1)
+    return rate >= 1 or (rate > 0 and _sample_rng.random() < rate)
+
+
+class Fields:
+    """ A log message `msg` with `fields` appended as `key=value` pairs,
+        formatted only when the record is emitted.
+    """
+    __slots__ = ("msg", "fields")
+
+    def __init__(self, msg: str, fields: Dict[str, Any]) -> None:
+        self.msg = msg
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return " ".join([self.msg, *(f"{k}={v}" for k, v in self.fields.items())])
+
+
+def log(
+    logger: logging.Logger, category: str, level: int, msg: str, **fields: Any,
+) -> None:
+    """ Log `msg` with `fields` to `logger` if `level` is enabled
+        and the record of `category` is sampled.
+    """
+    if logger.isEnabledFor(level) and sampled(category):
+        logger.log(level, Fields(msg, fields),
+                   extra={"category": category}, stacklevel=2)
+
+
+_redact_pat: Optional["re.Pattern[str]"] = re.compile(
+    r'("(?:%s)"\s*:\s*)"(?:[^"\\]|\\.)*"' % "|".join(map(re.escape, redact_keys))
+) if redact_keys else None
+
+
+class Body:
+    """ A request body `body` logged with its values of `redact_keys` redacted
+        and truncated to `body_max_len` characters, done only when emitted.
+    """
+    __slots__ = ("body",)
+
+    def __init__(self, body: str) -> None:
+        self.body = body
+
+    def __str__(self) -> str:
+        res = self.body
+        if _redact_pat is not None:
+            res = _redact_pat.sub(r'\1"***"', res)
+        if len(res) > body_max_len:
+            res = f"{res[:body_max_len]}...(+{len(res) - body_max_len} chars)"
+        return res
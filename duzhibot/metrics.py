@@ -0,0 +1,198 @@
+""" metrics
+    Lightweight counters and histograms exposed in the Prometheus text format.
+"""
+
+import bisect
+import threading
+import time
+from abc import ABC, abstractmethod
+from functools import partial
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+Labels_t = Tuple[str, ...]
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    res = ",".join(
+        [*(f'{k}="{_escape(str(v))}"' for k, v in zip(names, values)),
+         *([extra] if extra else [])])
+    return f"{{{res}}}" if res else ""
+
+
+class _Metric(ABC):
+    type_name = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """ Return the lines of the samples in the Prometheus text format. """
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type_name}",
+            *self.samples(),
+        ]
+
+
+class Counter(_Metric):
+    """ A monotonically increasing count per combination of label values. """
+    type_name = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: Dict[Labels_t, float] = {} if labels else {(): 0}
+
+    def inc(self, *label_values: str, value: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {v}" for k, v in values]
+
+
+class Gauge(_Metric):
+    """ Values per combination of label values read by `collect()` when rendered,
+        for exposing the counters kept elsewhere.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], Dict[Labels_t, float]],
+        labels: Sequence[str] = (),
+        type_name: str = "gauge",
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.type_name = type_name
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {v}"
+                for k, v in self.collect().items()]
+
+
+def stats_metrics(
+    name: str,
+    help: str,
+    collect: Callable[[], Dict[Labels_t, float]],
+    counters: Mapping[str, str],
+    labels: Sequence[str] = ("stat",),
+) -> None:
+    """ Expose the stats from `collect()`, whose last label is the stat name.
+        The stats in `counters` are exposed as counters named `{name}_{stat}_total`
+        with the mapped help texts and without the last label,
+        and the others as a gauge named `name`.
+    """
+    def collect_gauges() -> Dict[Labels_t, float]:
+        return {k: v for k, v in collect().items() if k[-1] not in counters}
+
+    def collect_counter(stat: str) -> Dict[Labels_t, float]:
+        return {k[:-1]: v for k, v in collect().items() if k[-1] == stat}
+
+    Gauge(name, help, collect_gauges, labels)
+    for stat, counter_help in counters.items():
+        Gauge(f"{name}_{stat}_total", counter_help, partial(collect_counter, stat),
+              labels[:-1], type_name="counter")
+
+
+_default_buckets = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+""" The upper bounds of the buckets in seconds, from 100 µs to 10 s. """
+
+
+class _Timer:
+    __slots__ = ("hist", "label_values", "beg")
+
+    def __init__(self, hist: "Histogram", label_values: Labels_t) -> None:
+        self.hist = hist
+        self.label_values = label_values
+
+    def __enter__(self) -> "_Timer":
+        self.beg = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.hist.observe(time.perf_counter() - self.beg, *self.label_values)
+
+
+class Histogram(_Metric):
+    """ The distribution of observed values per combination of label values. """
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = _default_buckets,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # [count per bucket..., count above all buckets], sum
+        self._values: Dict[Labels_t, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        k = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = (
+                    [0] * (len(self.buckets) + 1), [0.0])
+            entry[0][k] += 1
+            entry[1][0] += value
+
+    def time(self, *label_values: str) -> _Timer:
+        """ Return a context manager which observes the seconds spent in it. """
+        return _Timer(self, label_values)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(k, list(counts), total[0])
+                      for k, (counts, total) in self._values.items()]
+        res = []
+        for k, counts, total in values:
+            acc = 0
+            for le, n in zip([*map(str, self.buckets), "+Inf"], counts):
+                acc += n
+                le_label = f'le="{le}"'
+                res.append(
+                    f"{self.name}_bucket{_fmt_labels(self.labels, k, le_label)} {acc}")
+            res.append(f"{self.name}_sum{_fmt_labels(self.labels, k)} {total}")
+            res.append(f"{self.name}_count{_fmt_labels(self.labels, k)} {acc}")
+        return res
+
+
+stage_seconds = Histogram(
+    "duzhibot_stage_seconds", "Seconds spent in each stage of handling webhooks",
+    ["stage"])
+
+
+def stage(name: str) -> _Timer:
+    """ Return a context manager which times the stage `name`. """
+    return stage_seconds.time(name)
+
+
+def render(metrics: Optional[Sequence[_Metric]] = None) -> str:
+    """ Return `metrics` (default: all) in the Prometheus text format. """
+    lines: List[str] = []
+    for m in metrics if metrics is not None else _registry:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
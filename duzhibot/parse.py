@@ -12,13 +12,19 @@
 
 import itertools
 import re
+import threading
+import time
 from functools import partial
-from typing import (Any, Callable, Dict, Iterator, List, NamedTuple, Optional,
-                    OrderedDict, Tuple, Type, Union, cast)
+from types import MappingProxyType
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Mapping,
+                    NamedTuple, Optional, OrderedDict, Tuple, Type, Union,
+                    cast)
 
-from fsm_utils import (EventData, HierarchicalGraphMachine, MachineCtxMnger,
-                       Tags, add_resetters, add_state_features,
-                       ignore_transitions)
+import metrics
+from fsm_utils import (EventData, HierarchicalMachine, Machine,
+                       MachineCtxMngable, ModelPool, Tags, add_resetters,
+                       add_state_features, build_graph_machine,
+                       ignore_transitions, runtime_configs)
 
 # Token definitions
 
@@ -110,10 +116,15 @@ _lex_machine_configs = {
     "show_conditions": True,
 }
 
-_lex_machine = HierarchicalGraphMachine(**_lex_machine_configs)
+_lex_machine = HierarchicalMachine(**runtime_configs(_lex_machine_configs))
 
 
-class _LexModel(MachineCtxMnger(_lex_machine)):
+def build_lex_graph_machine() -> Machine:
+    """ Return a new lexer machine with graph support for drawing. """
+    return build_graph_machine(_lex_machine_configs)
+
+
+class _LexModel(MachineCtxMngable):
     """ A model class for lexing (tokenizing) text message. """
     state: Union[partial, Any]
     trigger: Union[partial, Any]
@@ -136,22 +147,127 @@ class _LexModel(MachineCtxMnger(_lex_machine)):
         return idx + 1, None  # Ignore the invalid character
 
 
-def lex(text: str) -> Iterator[Tuple[int, Token_t]]:
-    """ Return an iterator of (tokens, their index) for `str` `text`. """
-    with _LexModel() as model:
+_lex_models = ModelPool(
+    _lex_machine, _LexModel,
+    partial(HierarchicalMachine, **runtime_configs(_lex_machine_configs)))
+
+
+def lex_fsm(text: str) -> Iterator[Tuple[int, Token_t]]:
+    """ Return an iterator of (tokens, their index) for `str` `text`.
+        Driven by `_lex_machine`; `lex()` should be preferred.
+        The tokens are collected before returning the pooled model,
+        so that iterating partially does not hold the model.
+    """
+    res = []
+    with _lex_models() as model:
         idx = 0
         len_text = len(text)
         while idx < len_text:
             idx_nxt, token = model.step(text, idx)
             if token is not None:
-                yield idx, token
+                res.append((idx, token))
             idx = idx_nxt
+    return iter(res)
+
+
+# Compiled lexer
+
+_lex_conds: List[str] = cast(List[str], _lex_machine_configs["states"])
+""" The lexer conditions. The index is used as the condition id. """
+_lex_cond_nxt: Dict[str, int] = {
+    ttype: _lex_conds.index(dest)
+    for ttype, _, dest in _lex_machine_configs["transitions"]
+}
+""" The id of the condition to switch to after each token type. """
+_lex_cond_initial = _lex_conds.index(
+    cast(str, _lex_machine_configs["initial"]))
+
+_FLAGS_SCOPED = re.IGNORECASE | re.MULTILINE | re.DOTALL | re.VERBOSE
+
+_LexRule = NamedTuple(
+    "_LexRule", ttype=str, spec=PatSpec, grps=range, cls=Type[Token_t],
+    cond_nxt=int,
+)
+_LexTbl = NamedTuple(
+    "_LexTbl", pat=re.Pattern, rules=Dict[str, _LexRule], order=List[_LexRule],
+)
+
+
+def _compile_lex_tbl(cond: str) -> _LexTbl:
+    """ Return a lexing table for the condition `cond`
+        whose alternation pattern tries all applicable token patterns in order.
+    """
+    alts: List[str] = []
+    rules: Dict[str, _LexRule] = {}
+    order: List[_LexRule] = []
+    grp = 1
+    for ttype, spec in token_specs.items():
+        if spec.cond != "*" and spec.cond != cond:
+            continue
+        flags = "".join(
+            c for c, f in [("i", re.I), ("m", re.M), ("s", re.S), ("x", re.X)]
+            if spec.pat.flags & _FLAGS_SCOPED & f)
+        pat = f"(?{flags}:{spec.pat.pattern})" if flags else spec.pat.pattern
+        alts.append(f"(?P<{ttype}>{pat})")
+        rules[ttype] = _LexRule(
+            ttype, spec, range(grp + 1, grp + 1 + spec.pat.groups),
+            token_classes[ttype], _lex_cond_nxt[ttype])
+        order.append(rules[ttype])
+        grp += 1 + spec.pat.groups
+    return _LexTbl(re.compile("|".join(alts)), rules, order)
+
+
+_lex_tbls: List[_LexTbl] = [_compile_lex_tbl(cond) for cond in _lex_conds]
+""" The lexing tables. The index is the condition id. """
+
+
+def _lex_fallback(
+    tbl: _LexTbl, rule: _LexRule, text: str, idx: int,
+) -> Optional[Tuple[_LexRule, re.Match, Tuple]]:
+    """ Try the patterns after `rule` in `tbl` one by one
+        for `str` `text` with offset `idx`.
+        Return (the matched rule, the match, the transformed groups) if found.
+    """
+    for rule in tbl.order[tbl.order.index(rule) + 1:]:
+        match = rule.spec.pat.match(text, idx)
+        if match is None:
+            continue
+        res = rule.spec.xform(*match.groups())
+        if res is not None:
+            return rule, match, res
+    return None
+
+
+def lex(text: str) -> Iterator[Tuple[int, Token_t]]:
+    """ Return an iterator of (tokens, their index) for `str` `text`.
+        Yield the same tokens as `lex_fsm()` in a single pass of `text`.
+    """
+    cond = _lex_cond_initial
+    idx = 0
+    len_text = len(text)
+    while idx < len_text:
+        tbl = _lex_tbls[cond]
+        match = tbl.pat.match(text, idx)
+        if match is None:
+            idx += 1  # Ignore the invalid character
+            continue
+        rule = tbl.rules[cast(str, match.lastgroup)]
+        res = rule.spec.xform(*(match.group(g) for g in rule.grps))
+        if res is None:  # Rejected by the transformation; try the others
+            fallback = _lex_fallback(tbl, rule, text, idx)
+            if fallback is None:
+                idx += 1  # Ignore the invalid character
+                continue
+            rule, match, res = fallback
+        yield idx, rule.cls(*res)
+        cond = rule.cond_nxt
+        idx = match.end()
 
 
 # Parser
 
 @add_state_features(Tags)  # For marking accepted states
-class _ParseMachine(HierarchicalGraphMachine):
+class _ParseMachine(HierarchicalMachine):
     pass
 
 
@@ -202,10 +318,15 @@ ignore_transitions(
     _parse_machine_configs, ["TNewline", "TIndent", "TSpace"], "=")
 
 
-_parse_machine = _ParseMachine(**_parse_machine_configs)
+_parse_machine = _ParseMachine(**runtime_configs(_parse_machine_configs))
+
 
+def build_parse_graph_machine() -> Machine:
+    """ Return a new parser machine with graph support for drawing. """
+    return build_graph_machine(_parse_machine_configs, Tags)
 
-class _ParseModel(MachineCtxMnger(_parse_machine)):
+
+class _ParseModel(MachineCtxMngable):
     """ A model class for parsing text message. """
     state: Union[partial, Any]
     trigger: Union[partial, Any]
@@ -217,35 +338,306 @@ class _ParseModel(MachineCtxMnger(_parse_machine)):
 
     def __init__(self, ev: EventData = None) -> None:
         super().__init__()
+        self._reset()
+
+    def _reset(self) -> None:
         self.cmd = None
         self.args = []
         self.kwargs = {}
 
     def step(self, token: Token_t) -> bool:
-        """ Return (is expected here, its value if expected) for token `token`.
-        """
-        tname = type(token).__name__
-        tvalue = getattr(token, "value", None)
-        repr = token_specs[tname].repr
-        tvalue = repr(token) if repr is not None else None
-        avail_triggers = _parse_machine.get_triggers(self.state)
-        for trigger in [f"{tname}_{tvalue}", tname][tvalue is None:]:
+        """ Return whether token `token` is expected here. """
+        triggers, tvalue = _token_triggers(token)
+        avail_triggers = _parse_models.machine.get_triggers(self.state)
+        for trigger in triggers:
             if trigger in avail_triggers:
                 self.trigger(trigger, tvalue)
                 return True
         return False
 
 
-def parse(text: str) -> Tuple[Optional[str], List[Any], Dict[str, Any]]:
+_parse_models = ModelPool(
+    _parse_machine, _ParseModel,
+    partial(_ParseMachine, **runtime_configs(_parse_machine_configs)))
+
+
+def _token_triggers(token: Token_t) -> Tuple[List[str], Optional[str]]:
+    """ Return (the triggers to try in order, the trigger argument)
+        for token `token`.
+    """
+    tname = type(token).__name__
+    repr = token_specs[tname].repr
+    tvalue = repr(token) if repr is not None else None
+    return [f"{tname}_{tvalue}", tname][tvalue is None:], tvalue
+
+
+def parse_fsm(text: str) -> Tuple[Optional[str], List[Any], Dict[str, Any]]:
     """ Return (parsed command if valid, parsed arguments) for `str` `text`.
+        Driven by `_parse_machine`; `parse()` should be preferred.
     """
-    with _ParseModel() as model:
+    with _parse_models() as model:
         # parse and collect arguments
         for _, t in lex(text):
             if not model.step(t):
                 break
-        if not _parse_machine.get_state(model.state).is_accepted:
+        if not _parse_models.machine.get_state(model.state).is_accepted:
             return None, [], {}
 
         # Get the corresponding command for the parsing result
         return model.cmd, model.args, model.kwargs
+
+
+# Table-driven parser
+
+_ParseEntry = NamedTuple(
+    "_ParseEntry", dest=int, acts=Tuple[Callable[[EventData], Any], ...],
+)
+_ParseTbl = NamedTuple(
+    "_ParseTbl",
+    initial=int,
+    accepted=List[bool],
+    trigger_ids=Dict[str, int],
+    entries=List[List[Optional[_ParseEntry]]],
+)
+
+
+def _is_static_machine(machine: _ParseMachine) -> bool:
+    """ Return whether the transitions of `machine` depend only on
+        the current state and the trigger.
+    """
+    if any(getattr(machine, k) for k in [
+            "before_state_change", "after_state_change",
+            "prepare_event", "finalize_event"]):
+        return False
+    if not machine.send_event:  # Callbacks are to be called with EventData
+        return False
+    return all(
+        not (t.conditions or t.prepare or t.before or t.after)
+        for t in machine.get_nested_transitions())
+
+
+def _compile_parse_tbl() -> Optional[_ParseTbl]:
+    """ Return a transition table (state id x trigger id) for `_parse_machine`
+        whose entries hold (the destination state id, the callbacks to invoke)
+        if the trigger is available.
+        Return `None` if the transitions cannot be tabulated.
+    """
+    if not _is_static_machine(_parse_machine):
+        return None
+    states = _parse_machine.get_nested_state_names()
+    state_ids = {name: k for k, name in enumerate(states)}
+    trigger_ids = {
+        name: k for k, name in enumerate(
+            dict.fromkeys(_parse_machine.get_nested_triggers()))
+    }
+
+    # Record the callbacks invoked by each transition instead of calling them
+    acts: List[Callable[[EventData], Any]] = []
+    state_objs = [_parse_machine.get_state(name) for name in states]
+    callbacks = [(s.on_enter, s.on_exit) for s in state_objs]
+    for s, (enter, exit) in zip(state_objs, callbacks):
+        s.on_enter = [partial(lambda cbs, ev: acts.extend(cbs), enter)]
+        s.on_exit = [partial(lambda cbs, ev: acts.extend(cbs), exit)]
+    try:
+        with _parse_models() as probe:
+            initial = state_ids[probe.state]
+            entries: List[List[Optional[_ParseEntry]]] = []
+            for name in states:
+                avail_triggers = set(_parse_machine.get_triggers(name))
+                row: List[Optional[_ParseEntry]] = [None] * len(trigger_ids)
+                for trigger, tid in trigger_ids.items():
+                    if trigger not in avail_triggers:
+                        continue
+                    _parse_machine.set_state(name, probe)
+                    acts.clear()
+                    probe.trigger(trigger, None)
+                    row[tid] = _ParseEntry(state_ids[probe.state], tuple(acts))
+                entries.append(row)
+    finally:
+        for s, (enter, exit) in zip(state_objs, callbacks):
+            s.on_enter, s.on_exit = enter, exit
+
+    return _ParseTbl(
+        initial,
+        [bool(s.is_accepted) for s in state_objs],
+        trigger_ids,
+        entries,
+    )
+
+
+_parse_tbl = _compile_parse_tbl()
+
+
+def parse_tbl(text: str) -> Tuple[Optional[str], List[Any], Dict[str, Any]]:
+    """ Return (parsed command if valid, parsed arguments) for `str` `text`.
+        Give the same result as `parse_fsm()`
+        using the transition table compiled from `_parse_machine`.
+    """
+    if _parse_tbl is None:
+        return parse_fsm(text)
+    return _parse_tokens(_parse_tbl, lex(text))
+
+
+def _parse_tokens(
+    tbl: _ParseTbl, tokens: Iterable[Tuple[int, Token_t]],
+) -> Tuple[Optional[str], List[Any], Dict[str, Any]]:
+    """ Return (parsed command if valid, parsed arguments)
+        for `tokens` from `lex()` using the transition table `tbl`.
+    """
+    model = _ParseModel()  # Not attached; used only for collecting results
+    sid = tbl.initial
+    for _, t in tokens:
+        triggers, tvalue = _token_triggers(t)
+        row = tbl.entries[sid]
+        for trigger in triggers:
+            tid = tbl.trigger_ids.get(trigger)
+            entry = row[tid] if tid is not None else None
+            if entry is not None:
+                break
+        else:
+            break  # Not expected here
+        if entry.acts:
+            ev = EventData(None, None, _parse_machine, model, (tvalue,), {})
+            for f in entry.acts:
+                f(ev)
+        sid = entry.dest
+    if not tbl.accepted[sid]:
+        return None, [], {}
+
+    # Get the corresponding command for the parsing result
+    return model.cmd, model.args, model.kwargs
+
+
+# Parse result cache
+
+ParseRes_t = Tuple[Optional[str], Tuple[Any, ...], Mapping[str, Any]]
+
+
+class ParseCache:
+    """ A bounded LRU cache of immutable parse results keyed by message text.
+        Texts longer than `max_text_len` are not cached.
+    """
+    maxsize: int
+    max_text_len: int
+    hits: int
+    misses: int
+    evictions: int
+    _entries: OrderedDict[str, ParseRes_t]
+    _lock: threading.Lock
+
+    def __init__(self, maxsize: int = 1024, max_text_len: int = 256) -> None:
+        self.maxsize = maxsize
+        self.max_text_len = max_text_len
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def resize(self, maxsize: int) -> None:
+        """ Set the max number of entries to `maxsize` and evict the excess. """
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def get(self, text: str) -> Optional[ParseRes_t]:
+        """ Return the cached result for `str` `text` if found. """
+        with self._lock:
+            res = self._entries.get(text)
+            if res is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(text)
+            self.hits += 1
+            return res
+
+    def put(self, text: str, res: ParseRes_t) -> None:
+        """ Cache the result `res` for `str` `text` if it is short enough. """
+        if len(text) > self.max_text_len:
+            return
+        with self._lock:
+            self._entries[text] = res
+            self._entries.move_to_end(text)
+            self._evict()
+
+    def warm(self, texts: Iterable[str]) -> None:
+        """ Parse and cache `texts` in advance. """
+        for text in texts:
+            if self.get(text) is None:
+                self.put(text, _freeze(parse_tbl(text)))
+
+    def clear(self) -> None:
+        """ Remove all entries and reset the counters. """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        """ Return the size and the counters of the cache. """
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _evict(self) -> None:
+        while len(self._entries) > max(self.maxsize, 0):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+parse_cache = ParseCache()
+
+metrics.stats_metrics(
+    "duzhibot_parse_cache", "The size of the parse result cache",
+    lambda: {(k,): v for k, v in parse_cache.stats().items()}, {
+        "hits": "Lookups found in the parse result cache",
+        "misses": "Lookups not found in the parse result cache",
+        "evictions": "Entries evicted from the parse result cache",
+    })
+
+
+def _freeze(res: Tuple[Optional[str], List[Any], Dict[str, Any]]) -> ParseRes_t:
+    """ Return an immutable copy of the parse result `res`. """
+    cmd, args, kwargs = res
+    return cmd, tuple(args), MappingProxyType(dict(kwargs))
+
+
+class _TimedIter(Iterator[Any]):
+    """ An iterator over `it` which sums up the seconds spent in `it`. """
+    __slots__ = ("it", "elapsed")
+
+    def __init__(self, it: Iterator[Any]) -> None:
+        self.it = it
+        self.elapsed = 0.0
+
+    def __next__(self) -> Any:
+        beg = time.perf_counter()
+        try:
+            return next(self.it)
+        finally:
+            self.elapsed += time.perf_counter() - beg
+
+
+def parse(text: str) -> ParseRes_t:
+    """ Return (parsed command if valid, parsed arguments) for `str` `text`.
+        The result is immutable and might be shared via `parse_cache`.
+    """
+    res = parse_cache.get(text)
+    if res is None:
+        if _parse_tbl is None:
+            with metrics.stage("parse"):
+                res = _freeze(parse_fsm(text))
+        else:
+            # Tokens are lexed lazily as the parser might stop early
+            tokens = _TimedIter(lex(text))
+            beg = time.perf_counter()
+            res = _freeze(_parse_tokens(_parse_tbl, tokens))
+            metrics.stage_seconds.observe(tokens.elapsed, "lex")
+            metrics.stage_seconds.observe(
+                time.perf_counter() - beg - tokens.elapsed, "parse")
+        parse_cache.put(text, res)
+    return res
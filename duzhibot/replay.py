@@ -0,0 +1,233 @@
+""" replay
+    Replaying recorded webhook bodies against the app for load testing.
+
+    Usage: python -m duzhibot.replay [options] recorded.jsonl
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from evqueue import event_user_id
+
+Recorded = NamedTuple(
+    "Recorded", body=str, users=Tuple[str, ...],
+)
+Post_t = Callable[[str, str], int]
+
+
+def load_recorded(path: str) -> List[Recorded]:
+    """ Return the webhook bodies recorded at `path` as JSON Lines.
+        Each line is either a webhook body or an object with the body
+        as the value of `"body"`, which may be JSON-encoded.
+    """
+    res = []
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            body = obj.get("body", obj) if "events" not in obj else obj
+            if isinstance(body, str):
+                body = json.loads(body)
+            if not isinstance(body, dict) or "events" not in body:
+                raise ValueError(f"{path}:{lineno}: not a webhook body")
+            users = tuple(dict.fromkeys(
+                event_user_id(ev) for ev in body["events"]))
+            res.append(Recorded(json.dumps(body, ensure_ascii=False), users))
+    return res
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """ Return the `p`-th percentile of `sorted_values` by the nearest rank. """
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[k]
+
+
+def replay(
+    recorded: List[Recorded], make_post: Callable[[], Post_t],
+    concurrency: int = 1, rate: Optional[float] = None,
+) -> Dict[str, Any]:
+    """ Post `recorded` with `concurrency` threads, each posting with its own
+        function from `make_post()`, at most `rate` requests per second.
+        The bodies of each user are posted in order by the same thread
+        if they are of a single user.
+        Return the statistics; with `rate`, latencies count from the scheduled time.
+    """
+    lanes: List[List[Tuple[int, Recorded]]] = [[] for _ in range(concurrency)]
+    lane_of: Dict[str, int] = {}
+    for k, rec in enumerate(recorded):
+        key = rec.users[0] if rec.users else ""
+        lane = lane_of.setdefault(key, len(lane_of) % concurrency)
+        lanes[lane].append((k, rec))
+
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    lock = threading.Lock()
+    beg = time.perf_counter()
+
+    def run(lane: List[Tuple[int, Recorded]]) -> None:
+        post = make_post()
+        for k, rec in lane:
+            sched = beg + k / rate if rate else time.perf_counter()
+            delay = sched - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                status = str(post(rec.body, rec.users[0] if rec.users else ""))
+            except Exception as e:
+                status = type(e).__name__
+            latency = time.perf_counter() - sched
+            with lock:
+                latencies.append(latency)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    with ThreadPoolExecutor(concurrency) as ex:
+        for f in [ex.submit(run, lane) for lane in lanes if lane]:
+            f.result()
+    elapsed = time.perf_counter() - beg
+
+    latencies.sort()
+    n_events = sum(len(json.loads(rec.body)["events"]) for rec in recorded)
+    return {
+        "requests": len(recorded),
+        "events": n_events,
+        "seconds": elapsed,
+        "requests_per_sec": len(recorded) / elapsed if elapsed else 0.0,
+        "events_per_sec": n_events / elapsed if elapsed else 0.0,
+        "latency": {
+            **{f"p{p}": percentile(latencies, p) for p in [50, 90, 99]},
+            "max": latencies[-1] if latencies else 0.0,
+        },
+        "statuses": statuses,
+        "errors": sum(v for k, v in statuses.items() if k != "200"),
+    }
+
+
+def _app_module() -> Any:
+    """ Return the app module, importable without the LINE credentials. """
+    os.environ.setdefault("LINE_CHANNEL_SECRET", "replay")
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "replay")
+    import duzhibot.app as app_mod
+    return app_mod
+
+
+def _app(app_mod: Any, create_all: bool = True) -> Any:
+    """ Return a new app which records the replies instead of sending them,
+        using a temporary SQLite database unless `DATABASE_URL` is set.
+        Create the tables if `create_all` is `True`.
+    """
+    if "DATABASE_URL" not in os.environ:
+        tmp = tempfile.mkdtemp(prefix="duzhibot-replay-")
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'replay.db')}"
+    app = app_mod.App(app_mod.__name__)
+    app.register_blueprint(app_mod.bp)
+    app_mod.line_bot_api.reply_message = lambda *args, **kwargs: None
+    if create_all:
+        with app.app_context():
+            app_mod.db.create_all()
+    return app
+
+
+def user_states(app_mod: Any, app: Any, user_ids: List[str]) -> Dict[str, Optional[str]]:
+    """ Return the state of each of `user_ids` in the database of `app`. """
+    with app.app_context():
+        import db
+        states = dict(app_mod.db.session.query(db._User.user_id, db._User.state)
+                      .filter(db._User.user_id.in_(user_ids)))
+    return {u: states.get(u) for u in user_ids}
+
+
+def _client_post(app_mod: Any, app: Any, secret: str) -> Callable[[], Post_t]:
+    def make_post() -> Post_t:
+        client = app.test_client()
+
+        def post(body: str, user_id: str) -> int:
+            return client.post(
+                "/callback", data=body.encode("utf-8"), base_url="https://replay.invalid",
+                headers={"X-Line-Signature": app_mod._sign(body, secret),
+                         "Content-Type": "application/json"}).status_code
+        return post
+    return make_post
+
+
+def _http_post(app_mod: Any, url: str, secret: str, timeout: float) -> Callable[[], Post_t]:
+    import requests
+
+    def make_post() -> Post_t:
+        session = requests.Session()
+
+        def post(body: str, user_id: str) -> int:
+            return session.post(
+                url, data=body.encode("utf-8"), timeout=timeout,
+                headers={"X-Line-Signature": app_mod._sign(body, secret),
+                         "Content-Type": "application/json"}).status_code
+        return post
+    return make_post
+
+
+def main(argv: List[str]) -> None:
+    ap = argparse.ArgumentParser(
+        prog="python -m duzhibot.replay",
+        description="Replay recorded webhook bodies against the app.")
+    ap.add_argument("recorded", help="JSON Lines of webhook bodies")
+    ap.add_argument("--url", help="post to a running app at URL (e.g. "
+                    "http://localhost:8000/callback) instead of the test client")
+    ap.add_argument("-c", "--concurrency", type=int, default=1)
+    ap.add_argument("-r", "--rate", type=float, help="max requests per second")
+    ap.add_argument("--secret", help="the channel secret to sign the bodies with "
+                    "(default: LINE_CHANNEL_SECRET)")
+    ap.add_argument("--timeout", type=float, default=30.0)
+    ap.add_argument("--expect", help="JSON of the expected final state of each user")
+    ap.add_argument("--save-states", help="write the final state of each user as JSON")
+    ap.add_argument("-o", "--output", help="also write the results as JSON")
+    args = ap.parse_args(argv)
+
+    recorded = load_recorded(args.recorded)
+    app_mod = _app_module()
+    app = None
+    if not args.url:
+        app = _app(app_mod)
+    elif "DATABASE_URL" in os.environ:
+        # read the states from the database of the running app without setting it up
+        app = _app(app_mod, create_all=False)
+    elif args.expect or args.save_states:
+        ap.error("--expect and --save-states with --url need DATABASE_URL of the app")
+    secret = args.secret if args.secret is not None else app_mod.channel_secret
+    make_post = (_http_post(app_mod, args.url, secret, args.timeout) if args.url
+                 else _client_post(app_mod, app, secret))
+
+    res = replay(recorded, make_post, args.concurrency, args.rate)
+
+    user_ids = sorted({u for rec in recorded for u in rec.users if u})
+    states = user_states(app_mod, app, user_ids) if app is not None else {}
+    if args.save_states:
+        with open(args.save_states, "w") as f:
+            json.dump(states, f, indent=2)
+    if args.expect:
+        with open(args.expect) as f:
+            expected = json.load(f)
+        res["mismatched_states"] = {
+            u: {"expected": v, "actual": states.get(u)}
+            for u, v in expected.items() if states.get(u) != v
+        }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(res, f, indent=2)
+    json.dump(res, sys.stdout, indent=2)
+    print()
+    if res["errors"] or res.get("mismatched_states"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
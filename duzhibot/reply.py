@@ -0,0 +1,205 @@
+""" reply
+    Asynchronous, pooled sender for replying with the LINE Messaging API.
+"""
+
+import atexit
+import logging
+import queue
+import random
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import requests
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import HttpClient, RequestsHttpClient, RequestsHttpResponse
+from linebot.models import SendMessage
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class SessionHttpClient(RequestsHttpClient):
+    """ A `RequestsHttpClient` which reuses keep-alive connections
+        from a pool of at most `pool_size` connections per host.
+    """
+    session: requests.Session
+
+    def __init__(self, timeout: Any = HttpClient.DEFAULT_TIMEOUT, pool_size: int = 10) -> None:
+        super().__init__(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return RequestsHttpResponse(self.session.get(
+            url, headers=headers, params=params, stream=stream,
+            timeout=timeout if timeout is not None else self.timeout))
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.post(
+            url, headers=headers, data=data,
+            timeout=timeout if timeout is not None else self.timeout))
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.delete(
+            url, headers=headers, data=data,
+            timeout=timeout if timeout is not None else self.timeout))
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.put(
+            url, headers=headers, data=data,
+            timeout=timeout if timeout is not None else self.timeout))
+
+
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+""" The status codes of the responses which are worth retrying. """
+
+
+def is_transient(e: Exception) -> bool:
+    """ Return whether the error `e` from sending might not occur again. """
+    if isinstance(e, LineBotApiError):
+        return e.status_code in _RETRY_STATUS
+    return isinstance(
+        e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class _Reply(NamedTuple):
+    reply_token: str
+    msgs: List[SendMessage]
+    queued: float
+    deadline: float
+
+
+_latency = metrics.Histogram(
+    "duzhibot_reply_latency_seconds",
+    "Seconds from queuing to sending the sent replies, including the queue wait and the retries",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
+
+class ReplySender:
+    """ A sender which replies with `api` from a bounded queue
+        drained by `workers` threads in the background.
+        Transient errors are retried with exponential backoff
+        until `deadline` seconds after the reply is submitted,
+        since reply tokens expire soon after the webhook event.
+        Replies sent in the calling thread when the queue is full
+        are tried only once, so as not to block the caller.
+    """
+    api: LineBotApi
+    workers: int
+    deadline: float
+    backoff: float
+    sent: int
+    failed: int
+    expired: int
+    retried: int
+    overflowed: int
+    _queue: "queue.Queue[Optional[_Reply]]"
+    _threads: List[threading.Thread]
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        api: LineBotApi,
+        workers: int = 4,
+        max_queue: int = 1000,
+        deadline: float = 30.0,
+        backoff: float = 0.2,
+    ) -> None:
+        self.api = api
+        self.workers = workers
+        self.deadline = deadline
+        self.backoff = backoff
+        self.sent = self.failed = self.expired = 0
+        self.retried = self.overflowed = 0
+        self._queue = queue.Queue(max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, reply_token: str, msgs: List[SendMessage]) -> None:
+        """ Queue replying `msgs` with `reply_token`.
+            Reply in the calling thread without retries if the queue is full.
+        """
+        now = time.monotonic()
+        item = _Reply(reply_token, msgs, now, now + self.deadline)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self.overflowed += 1
+            self._send(item, max_attempts=1)
+
+    def start(self) -> None:
+        """ Start the worker threads. """
+        for k in range(self.workers):
+            th = threading.Thread(
+                target=self._run, name=f"ReplySender-{k}", daemon=True)
+            th.start()
+            self._threads.append(th)
+        atexit.register(self.stop)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """ Stop the worker threads after sending the queued replies. """
+        for _ in self._threads:
+            self._queue.put(None)
+        for th in self._threads:
+            th.join(timeout)
+        self._threads.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """ Return the queue depth and the counters of the sender. """
+        return {
+            "queue_depth": self._queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "expired": self.expired,
+            "retried": self.retried,
+            "overflowed": self.overflowed,
+        }
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._send(item)
+
+    def _send(self, item: _Reply, max_attempts: Optional[int] = None) -> None:
+        """ Reply `item` with retries until its deadline
+            or until `max_attempts` attempts if given.
+        """
+        attempt = 0
+        while True:
+            remaining = item.deadline - time.monotonic()
+            if remaining <= 0:
+                _LOGGER.warning(f"Reply expired: {item.reply_token}")
+                with self._lock:
+                    self.expired += 1
+                return
+            timeout = self.api.http_client.timeout
+            if isinstance(timeout, (int, float)):
+                timeout = min(remaining, timeout)
+            try:
+                self.api.reply_message(item.reply_token, item.msgs, timeout=timeout)
+            except Exception as e:
+                if not is_transient(e) or (
+                        max_attempts is not None and attempt + 1 >= max_attempts):
+                    _LOGGER.exception("Failed to reply", exc_info=e)
+                    with self._lock:
+                        self.failed += 1
+                    return
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                attempt += 1
+                with self._lock:
+                    self.retried += 1
+                time.sleep(max(min(delay, item.deadline - time.monotonic()), 0))
+                continue
+            _latency.observe(time.monotonic() - item.queued)
+            with self._lock:
+                self.sent += 1
+            return
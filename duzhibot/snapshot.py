@@ -0,0 +1,25 @@
+""" snapshot
+    Build the snapshot of the world machine ahead of starting the app,
+    so that the app loads the snapshot instead of building the machine.
+
+    Usage: python -m duzhibot.snapshot [path]
+    (default: $WORLD_SNAPSHOT)
+"""
+
+import sys
+from typing import List
+
+import fsm
+
+
+def main(argv: List[str]) -> None:
+    path = argv[0] if argv else fsm.world_snapshot_path
+    if path is None:
+        sys.exit("Specify the path or WORLD_SNAPSHOT as environment variable.")
+    snapshot = fsm.build_world_snapshot()
+    fsm.save_world_snapshot(path, snapshot)
+    print(f"{path}: {snapshot.digest}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,213 @@
+""" statecode
+    Compact integer codes of the states of the world machine for the database.
+
+    The codes are kept in `state_codes.json` along with this module.
+    A state keeps its code across versions of the world, even if renamed,
+    and the codes of the removed states are never reused.
+
+    Usage: python -m duzhibot.statecode update [--rename OLD=NEW ...]
+           python -m duzhibot.statecode migrate [--batch-size N]
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+codes_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "state_codes.json")
+""" The path of the mapping from the state names to their codes. """
+
+max_code = 2 ** 15 - 1
+""" The max code which fits in a `SMALLINT`. """
+
+StateCodes = NamedTuple(
+    "StateCodes", version=int, codes=Dict[str, int], renamed=Dict[str, str],
+)
+
+
+def load_codes(path: str = codes_path) -> StateCodes:
+    """ Return the state codes saved at `path`, or empty ones if not existing. """
+    try:
+        with open(path, encoding="utf-8") as f:
+            obj = json.load(f)
+    except FileNotFoundError:
+        return StateCodes(0, {}, {})
+    return StateCodes(obj["version"], obj["codes"], obj["renamed"])
+
+
+def save_codes(codes: StateCodes, path: str = codes_path) -> None:
+    """ Save the state codes `codes` to `path`. """
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(codes._asdict(), f, indent=2)
+        f.write("\n")
+
+
+def update_codes(
+    codes: StateCodes, names: Sequence[str], renames: Dict[str, str] = {},
+) -> StateCodes:
+    """ Return `codes` with `renames` from the old to the new state names applied
+        and new codes for the states in `names` without one,
+        with the version bumped if anything is changed.
+    """
+    res = dict(codes.codes)
+    renamed = dict(codes.renamed)
+    for old, new in renames.items():
+        if old not in res:
+            raise ValueError(f"Renamed state {old!r} has no code")
+        if new in res:
+            raise ValueError(f"Renamed state {new!r} already has a code")
+        res[new] = res.pop(old)
+        # Redirect the earlier renames as well
+        renamed = {k: new if v == old else v for k, v in renamed.items()}
+        renamed[old] = new
+    code = max(res.values(), default=0)
+    for name in names:
+        if name not in res:
+            code += 1
+            res[name] = code
+    if code > max_code:
+        raise ValueError(f"Too many states for codes up to {max_code}")
+    if res == codes.codes and renamed == codes.renamed:
+        return codes
+    return StateCodes(codes.version + 1, res, renamed)
+
+
+class StateCodec:
+    """ Encoding between the names and the codes of the states in `names`.
+        The states without a valid code are decoded as `invalid`.
+    """
+    codes: StateCodes
+    invalid: str
+    _encode: Dict[str, int]
+    _decode: List[Optional[str]]
+
+    def __init__(self, codes: StateCodes, names: Sequence[str], invalid: str) -> None:
+        missing = [name for name in names if name not in codes.codes]
+        if missing:
+            raise ValueError(
+                f"States without codes: {', '.join(missing)};"
+                " run `python -m duzhibot.statecode update` first")
+        self.codes = codes
+        self.invalid = invalid
+        self._encode = {name: codes.codes[name] for name in names}
+        self._decode = [None] * (max(self._encode.values(), default=0) + 1)
+        for name, code in self._encode.items():
+            self._decode[code] = name
+
+    def encode(self, state: str) -> int:
+        """ Return the code of `state`, or of `invalid` if it has no code. """
+        res = self._encode.get(state)
+        return res if res is not None else self._encode[self.invalid]
+
+    def decode(self, code: int) -> str:
+        """ Return the state of `code`, or `invalid` if it is not a valid code. """
+        res = self._decode[code] if 0 <= code < len(self._decode) else None
+        return res if res is not None else self.invalid
+
+    def __contains__(self, state: str) -> bool:
+        return state in self._encode
+
+    def renamed(self, state: str) -> str:
+        """ Return the current name of `state` named in any version of the world. """
+        return self.codes.renamed.get(state, state)
+
+
+def migrate(engine, codec: StateCodec, batch_size: int = 1000) -> Dict[str, int]:
+    """ Convert the state names in the user table at `engine`
+        to the codes by `codec` in batches of `batch_size` users.
+        The state names are replaced with the codes once all users are converted.
+        Return the counts of the converted users.
+    """
+    import sqlalchemy as sa
+
+    from db import _User
+    table_name = _User.__table__.name
+    table = sa.table(
+        table_name, sa.column("id", sa.Integer), sa.column("state", sa.Text),
+        sa.column("state_code", sa.SmallInteger))
+    quoted = engine.dialect.identifier_preparer.format_table(_User.__table__)
+    res = {"users": 0, "renamed": 0, "invalid": 0}
+
+    columns = {c["name"] for c in sa.inspect(engine).get_columns(table_name)}
+    if "state" not in columns:  # Converted already
+        return res
+    if "state_code" not in columns:
+        with engine.begin() as conn:
+            conn.execute(sa.text(f"ALTER TABLE {quoted} ADD COLUMN state_code SMALLINT"))
+
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                sa.select(table.c.id, table.c.state)
+                .where(table.c.id > last_id)
+                .order_by(table.c.id)
+                .limit(batch_size)).all()
+            if not rows:
+                break
+            params = []
+            for row in rows:
+                state = codec.renamed(row.state)
+                res["renamed"] += state != row.state
+                res["invalid"] += state not in codec
+                params.append({"row_id": row.id, "code": codec.encode(state)})
+            conn.execute(
+                table.update()
+                .where(table.c.id == sa.bindparam("row_id"))
+                .values(state_code=sa.bindparam("code")),
+                params)
+        res["users"] += len(rows)
+        last_id = rows[-1].id
+
+    with engine.begin() as conn:
+        if engine.dialect.name != "sqlite":  # Unsupported by SQLite
+            conn.execute(sa.text(
+                f"ALTER TABLE {quoted} ALTER COLUMN state_code SET NOT NULL"))
+        conn.execute(sa.text(f"ALTER TABLE {quoted} DROP COLUMN state"))
+    return res
+
+
+def _update(args: argparse.Namespace) -> None:
+    import world
+    from fsm_utils import get_state_names
+    renames = dict(v.split("=", 1) for v in args.rename)
+    codes = load_codes(args.path)
+    res = update_codes(codes, get_state_names(world.world), renames)
+    if res is codes:
+        print(f"{args.path}: version {res.version} (unchanged)")
+        return
+    save_codes(res, args.path)
+    print(f"{args.path}: version {res.version}")
+
+
+def _migrate(args: argparse.Namespace) -> None:
+    import duzhibot.app as app_mod
+    import db
+    app = app_mod.App(app_mod.__name__)
+    with app.app_context():
+        res = migrate(app_mod.db.get_engine(), db.state_codec, args.batch_size)
+    json.dump(res, sys.stdout)
+    print()
+
+
+def main(argv: List[str]) -> None:
+    ap = argparse.ArgumentParser(
+        prog="python -m duzhibot.statecode",
+        description="Maintain the codes of the states stored in the database.")
+    sub = ap.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("update", help="assign codes to the new states")
+    p.add_argument("--rename", action="append", default=[], metavar="OLD=NEW",
+                   help="keep the code of the state OLD for the state NEW")
+    p.add_argument("--path", default=codes_path)
+    p.set_defaults(run=_update)
+    p = sub.add_parser("migrate", help="convert the state names in the database"
+                       " at DATABASE_URL to the codes")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(run=_migrate)
+    args = ap.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
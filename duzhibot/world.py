@@ -1,25 +1,23 @@
-import random
 from copy import deepcopy
-from functools import partial, reduce
-from typing import Callable, List, Optional, OrderedDict, Tuple, cast
+from functools import partial
+from typing import Callable, List, OrderedDict, Tuple, cast
 
-import linebot.models as lm
 from transitions.core import Event
 
-from fsm_utils import (EventData, State_t, TransDictSpec_t, TransList_t, add_resetters, get_state_names,
-                       get_transitions, resolve_initial)
-
-trig_lambda = "λ"
+from fsm_utils import (ConfigIndex, State_t, TransDictSpec_t, TransList_t,
+                       add_resetters, get_state_names, get_transitions,
+                       resolve_initial)
+from world_rules import (chair_should, check_body_temperature, check_drawer_pw,
+                         check_hello, check_inroll, check_usernick,
+                         cmds_chair as _cmds_chair, do_mt19937,
+                         get_expected_chair_act, is_dst, is_mt19937_dst,
+                         mz_dim as _mz_dim, trig_lambda)
 
 # State hierarchy: {world: {area_*: {domain_*: {domain_*: {...}...}...}...}}
 # (area = top-level domain)
 # Cross-domain transitions: wrap_*
 
 
-def is_dst(dst: str, ev: EventData) -> bool:
-    return ev.kwargs["dst"] == dst
-
-
 DomainDict = OrderedDict[str, State_t]
 
 
@@ -74,28 +72,6 @@ def _auto_shut(name: str, init: bool = False) -> State_t:
     }
 
 
-def check_usernick(ev: EventData) -> bool:
-    nick: Optional[str] = ev.kwargs.get("nick")
-    if nick is None:
-        nick = ""  # TODO: get the user's nickname from the database
-    if nick.strip() == "":
-        ev.kwargs["reply"](lm.TextSendMessage(
-            text=f"'{nick}' 是空白的，是錯誤的使用者暱稱。"))
-        return False
-    ...  # TODO: save the user's nickname to the database
-    return True
-
-
-def check_hello(ev: EventData) -> bool:
-    cmd_name: str = ev.kwargs["cmd_name"]
-    dst: List[str] = ev.args
-    if len(dst) == 1 and dst[0].strip().lower() in ["world", "world!"]:
-        return True
-    ev.kwargs["reply"](lm.TextSendMessage(
-        text=f"{cmd_name} {' '.join(dst)}"))
-    return False
-
-
 area_init = {
     "name": "init",
     "states": ["init", "registered"],
@@ -117,20 +93,6 @@ wrap_init = [
 ]
 
 _sts_chair = _sts_room = _switch_sts
-_cmds_chair = ["stand", "sit"]
-
-
-def get_expected_chair_act(ev: EventData) -> None:
-    res = random.choice(_cmds_chair)
-    ev.model.chair_expected = res
-    ev.kwargs["reply"](lm.TextSendMessage(
-        text="你坐啊。" if res == "stand" else "你起來啊。"))
-
-
-def chair_should(act: str, ev: EventData) -> bool:
-    return ev.model.chair_expected == act
-
-
 doms_chair_st = DomainDict(
     standed="standed",
     sat="sat",
@@ -173,22 +135,6 @@ wrap_chair = [
     ), []),
 ]
 
-# The password for drawer
-draw_pw_tbl = []
-DRAWER_PW = str(reduce(
-    lambda x, y: x * y,
-    (v for v in range(1, 10)
-        if (not draw_pw_tbl.clear() if not v >> 1
-            else all(v % d for d in draw_pw_tbl)
-                and f"{draw_pw_tbl.append(v)}")),
-) << 1)[:-1]
-
-
-def check_drawer_pw(ev: EventData) -> bool:
-    pw: str = ev.kwargs["input"]
-    return pw == DRAWER_PW
-
-
 domain_drawer = {
     "name": "drawer",
     "states": [
@@ -313,29 +259,6 @@ _src_sq = OrderedDict[str, str]((v, k) for k, v in _path_sq)
 _dst_sq = OrderedDict[str, str]((k, v) for k, v in _path_sq)
 
 
-def check_body_temperature(dst: str, ev: EventData) -> bool:
-    # Simulate a forehead temporature measurement
-    tp = random.normalvariate(36.8, 0.7)
-    res = tp < 37.5 - 0.05  # Detected as not fever
-    ev.kwargs["reply"](lm.TextSendMessage(
-        text=f"額溫：{tp:.1f}℃ —— "
-        f"{'passed' if res else 'not passed' if dst != 'hospital' else '1922'}",
-    ))
-    return res
-
-
-_TUITION_FEE = 32768
-
-
-def check_inroll(ev: EventData) -> bool:
-    if not ...:  # TODO: check wealth
-        ev.kwargs["reply"](lm.TextSendMessage(
-            text=f"餘額不足：δ{...}/δ{_TUITION_FEE}……"))
-        return False
-    ...  # TODO: update wealth
-    return True
-
-
 doms_square = DomainDict(
     lobby="lobby",
     hospital="hospital",
@@ -401,20 +324,6 @@ wrap_square = [
 
 # TODO: design a proper maze layout
 
-_mz_dim = (4, 4)
-
-
-def do_mt19937(ev: EventData) -> None:
-    """ Randomly pick a destination.
-        (not necessarily using the mt19937 algorithm)
-    """
-    ev.model.mt19937_dst = Tuple(random.randrange(0, v) for v in _mz_dim)
-
-
-def is_mt19937_dst(pos: Tuple[int, int], ev: EventData) -> bool:
-    return ev.model.mt19937_dst == pos
-
-
 area_maze = {
     "name": "maze",
     "states": [
@@ -524,7 +433,6 @@ _excl = {
     *get_state_names(area_init, base="init"),
     *get_state_names(area_hell, base="hell"),
 }
+_world_index = ConfigIndex(world)
 for st, (trggr, kwargs) in _resetters_map.items():
-    add_resetters(world, [trggr], f"hell__{st}", excl=_excl, **kwargs)
-
-state_invalid = "hell__hacker"
+    add_resetters(world, [trggr], f"hell__{st}", excl=_excl, index=_world_index, **kwargs)
@@ -0,0 +1,113 @@
+""" world_rules
+    The conditions and the callbacks of the transitions of the world machine
+    and the constants which they and the app share,
+    importable without generating the config of the machine in `world`.
+"""
+
+import random
+from functools import reduce
+from typing import List, Optional, Tuple
+
+import linebot.models as lm
+
+from fsm_utils import EventData
+
+trig_lambda = "λ"
+
+state_invalid = "hell__hacker"
+""" The state for the users in unknown states. """
+
+
+def is_dst(dst: str, ev: EventData) -> bool:
+    return ev.kwargs["dst"] == dst
+
+
+def check_usernick(ev: EventData) -> bool:
+    nick: Optional[str] = ev.kwargs.get("nick")
+    if nick is None:
+        nick = ev.model.profile.nick or ""
+    if nick.strip() == "":
+        ev.kwargs["reply"](lm.TextSendMessage(
+            text=f"'{nick}' 是空白的，是錯誤的使用者暱稱。"))
+        return False
+    ev.model.profile.nick = nick
+    return True
+
+
+def check_hello(ev: EventData) -> bool:
+    cmd_name: str = ev.kwargs["cmd_name"]
+    dst: List[str] = ev.args
+    if len(dst) == 1 and dst[0].strip().lower() in ["world", "world!"]:
+        return True
+    ev.kwargs["reply"](lm.TextSendMessage(
+        text=f"{cmd_name} {' '.join(dst)}"))
+    return False
+
+
+cmds_chair = ["stand", "sit"]
+
+
+def get_expected_chair_act(ev: EventData) -> None:
+    res = random.choice(cmds_chair)
+    ev.model.chair_expected = res
+    ev.kwargs["reply"](lm.TextSendMessage(
+        text="你坐啊。" if res == "stand" else "你起來啊。"))
+
+
+def chair_should(act: str, ev: EventData) -> bool:
+    return ev.model.chair_expected == act
+
+
+# The password for drawer
+draw_pw_tbl = []
+DRAWER_PW = str(reduce(
+    lambda x, y: x * y,
+    (v for v in range(1, 10)
+        if (not draw_pw_tbl.clear() if not v >> 1
+            else all(v % d for d in draw_pw_tbl)
+                and f"{draw_pw_tbl.append(v)}")),
+) << 1)[:-1]
+
+
+def check_drawer_pw(ev: EventData) -> bool:
+    pw: str = ev.kwargs["input"]
+    return pw == DRAWER_PW
+
+
+def check_body_temperature(dst: str, ev: EventData) -> bool:
+    # Simulate a forehead temporature measurement
+    tp = random.normalvariate(36.8, 0.7)
+    res = tp < 37.5 - 0.05  # Detected as not fever
+    ev.kwargs["reply"](lm.TextSendMessage(
+        text=f"額溫：{tp:.1f}℃ —— "
+        f"{'passed' if res else 'not passed' if dst != 'hospital' else '1922'}",
+    ))
+    return res
+
+
+TUITION_FEE = 32768
+
+initial_wealth = 2 * TUITION_FEE
+
+
+def check_inroll(ev: EventData) -> bool:
+    profile = ev.model.profile
+    if not profile.spend(TUITION_FEE):
+        ev.kwargs["reply"](lm.TextSendMessage(
+            text=f"餘額不足：δ{profile.wealth}/δ{TUITION_FEE}……"))
+        return False
+    return True
+
+
+mz_dim = (4, 4)
+
+
+def do_mt19937(ev: EventData) -> None:
+    """ Randomly pick a destination.
+        (not necessarily using the mt19937 algorithm)
+    """
+    ev.model.mt19937_dst = tuple(random.randrange(0, v) for v in mz_dim)
+
+
+def is_mt19937_dst(pos: Tuple[int, int], ev: EventData) -> bool:
+    return ev.model.mt19937_dst == pos
@@ -0,0 +1,28 @@
+import os
+import sys
+from types import ModuleType
+from typing import Any, Iterator, Tuple
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import duzhibot  # noqa: E402,F401  # for importing the modules in it by their names
+
+
+@pytest.fixture
+def app(tmp_path: Any, monkeypatch: pytest.MonkeyPatch) -> Iterator[Tuple[ModuleType, Any]]:
+    """ Return (the app module, a new app in its app context)
+        which use a temporary SQLite database and do not send any replies.
+    """
+    monkeypatch.setenv("LINE_CHANNEL_SECRET", os.getenv("LINE_CHANNEL_SECRET", "test"))
+    monkeypatch.setenv(
+        "LINE_CHANNEL_ACCESS_TOKEN", os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "test"))
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'test.db'}")
+    import duzhibot.app as app_mod
+    res = app_mod.App(app_mod.__name__)
+    res.register_blueprint(app_mod.bp)
+    monkeypatch.setattr(app_mod.line_bot_api, "reply_message", lambda *args, **kwargs: None)
+    with res.app_context():
+        app_mod.db.create_all()
+        yield app_mod, res
+        app_mod.db.session.remove()
@@ -0,0 +1,135 @@
+from types import ModuleType
+from typing import Any, Tuple
+
+import pytest
+from sqlalchemy import select, update
+from sqlalchemy.orm.exc import StaleDataError
+
+import db
+import fsm
+
+
+def _move(user_id: str, state: str) -> None:
+    user = db.User.from_user_id(user_id)
+    with user.load_machine_model() as model:
+        fsm.world_machine.set_state(state, model)
+        user.save_machine_model(model)
+
+
+def _spend(user: db.User, state: str) -> None:
+    """ Move `user` to `state` and spend all of the loaded wealth. """
+    with user.load_machine_model() as model:
+        fsm.world_machine.set_state(state, model)
+        assert model.profile.spend(model.profile.wealth)
+        user.save_machine_model(model)
+
+
+def _set(user_id: str, **values: Any) -> None:
+    """ Write `values` to the user `user_id` as if by others. """
+    db.db.session.execute(
+        update(db._User).where(db._User.user_id == user_id)
+        .values(**values).execution_options(synchronize_session=False))
+    db.db.session.commit()
+    db.db.session.expire_all()
+
+
+def _stored(user_id: str) -> Tuple[str, int]:
+    """ Return the state and the wealth of the user `user_id` in the database. """
+    row = db.db.session.execute(
+        select(db._User.state, db._User.wealth).where(db._User.user_id == user_id)).one()
+    return row.state, row.wealth
+
+
+def _state_cache(app: Any, monkeypatch: pytest.MonkeyPatch) -> db.StateCache:
+    """ Enable writing behind without flushing by itself. """
+    res = db.StateCache(app, flush_interval=60)
+    monkeypatch.setattr(db, "state_cache", res)
+    return res
+
+
+def test_save(app: Tuple[ModuleType, Any]) -> None:
+    _move("U0", "init__registered")
+    _move("U0", "room_off__init")
+    assert db.User.from_user_id("U0").state == "room_off__init"
+    assert _stored("U0")[0] == "room_off__init"
+
+
+def test_conflict(app: Tuple[ModuleType, Any]) -> None:
+    _move("U0", "room_off__init")
+    conflicts = db._conflicts._values.get((), 0)
+    first, second = db.User.from_user_id("U0"), db.User.from_user_id("U0")
+    with first.load_machine_model() as model:
+        fsm.world_machine.set_state("hall__init", model)
+        first.save_machine_model(model)
+    with second.load_machine_model() as model:
+        fsm.world_machine.set_state("lobby__init", model)
+        with pytest.raises(StaleDataError):
+            second.save_machine_model(model)
+    assert _stored("U0")[0] == "hall__init"
+    assert db._conflicts._values[()] == conflicts + 1
+
+
+def test_write_behind(app: Tuple[ModuleType, Any], monkeypatch: pytest.MonkeyPatch) -> None:
+    _move("U0", "room_off__init")
+    cache = _state_cache(app[1], monkeypatch)
+    _move("U0", "lobby__init")
+    _move("U0", "lobby__clock")
+    assert _stored("U0")[0] == "room_off__init", "written before flushed"
+    assert db.User.from_user_id("U0").state == "lobby__clock", "not loaded from the cache"
+    assert cache.flush() == 1
+    assert _stored("U0")[0] == "lobby__clock"
+
+
+def test_write_behind_failed_commit(
+    app: Tuple[ModuleType, Any], monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """ A conflict and then a failed commit should keep the other pending states. """
+    _move("UA", "hall__init")
+    _move("UB", "hall__init")
+    cache = _state_cache(app[1], monkeypatch)
+    _move("UA", "lobby__init")
+    _move("UB", "lobby__init")
+    _set("UA", state="square__init")
+
+    def fail() -> None:
+        raise RuntimeError("commit failed")
+    with monkeypatch.context() as m:
+        m.setattr(db.db.session, "commit", fail)
+        with pytest.raises(RuntimeError):
+            cache.flush()
+    assert cache.flush() == 1, "pending state lost"
+    assert _stored("UA")[0] == "square__init"
+    assert _stored("UB")[0] == "lobby__init"
+
+
+def test_insufficient_wealth(app: Tuple[ModuleType, Any]) -> None:
+    """ Spending more than the wealth in the database should not be a conflict. """
+    _move("UW", "hall__init")
+    conflicts = db._conflicts._values.get((), 0)
+    insufficient = db._insufficient_wealth._values.get((), 0)
+    user = db.User.from_user_id("UW")
+    assert user.wealth > 0
+    _set("UW", wealth=0)
+    with pytest.raises(db.InsufficientWealthError):
+        _spend(user, "lobby__init")
+    assert _stored("UW") == ("hall__init", 0)
+    assert db._conflicts._values.get((), 0) == conflicts, "counted as a conflict"
+    assert db._insufficient_wealth._values[()] == insufficient + 1
+
+
+def test_insufficient_wealth_behind(
+    app: Tuple[ModuleType, Any], monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """ The state should be written without spending behind. """
+    _move("UW", "hall__init")
+    conflicts = db._conflicts._values.get((), 0)
+    insufficient = db._insufficient_wealth._values.get((), 0)
+    cache = _state_cache(app[1], monkeypatch)
+    _move("UW", "lobby__init")
+    _set("UW", wealth=0)
+    _spend(db.User.from_user_id("UW"), "lobby__clock")
+    assert cache.flush() == 1, "state not written"
+    assert cache.get("UW") is None, "wealth not reloaded"
+    assert _stored("UW") == ("lobby__clock", 0)
+    assert db._conflicts._values.get((), 0) == conflicts, "counted as a conflict"
+    assert db._insufficient_wealth._values[()] == insufficient + 1
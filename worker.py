@@ -0,0 +1,9 @@
+from duzhibot.app import App, bp, run_worker
+
+__all__ = ["app"]
+
+app = App(__name__, static_url_path="")
+app.register_blueprint(bp)
+
+if __name__ == "__main__":
+    run_worker(app)